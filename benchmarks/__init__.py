@@ -0,0 +1 @@
+# Benchmarks for broker_bot. Run from the repo root, e.g. `python -m benchmarks.bench_db`.
@@ -0,0 +1,101 @@
+# Micro-benchmark: aiosqlite.connect() per helper call (old path) vs the pooled DBGateway.
+#   python -m benchmarks.bench_db [--iters 500]
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+
+import aiosqlite
+
+import broker_bot as bb
+
+
+# --- old path: the helpers as they were before DBGateway (one connection per call)
+async def old_get_request(request_id):
+    async with aiosqlite.connect(bb.DB_PATH) as db:
+        cur = await db.execute("SELECT id, client_user_id, category, description, address_text, city, lat, lon, client_radius_km, mode, status, created_at FROM requests WHERE id=?", (request_id,))
+        return await cur.fetchone()
+
+async def old_get_executor(exec_id):
+    async with aiosqlite.connect(bb.DB_PATH) as db:
+        cur = await db.execute("SELECT id, user_id, pending_username, direct_tg_id, categories, city, lat, lon, radius_km, is_owner, is_active FROM executors WHERE id=?", (exec_id,))
+        return await cur.fetchone()
+
+async def old_tg_id_by_user_id(user_id):
+    async with aiosqlite.connect(bb.DB_PATH) as db:
+        cur = await db.execute("SELECT tg_id FROM users WHERE id=?", (user_id,))
+        row = await cur.fetchone()
+        return row[0] if row else None
+
+async def old_settings_get():
+    async with aiosqlite.connect(bb.DB_PATH) as db:
+        cur = await db.execute("SELECT prefer_owner_first FROM settings WHERE id=1")
+        r = await cur.fetchone()
+        return bool(r[0]) if r else True
+
+async def old_get_or_create_user(tg):
+    async with aiosqlite.connect(bb.DB_PATH) as db:
+        cur = await db.execute("SELECT id, role FROM users WHERE tg_id=?", (tg.id,))
+        row = await cur.fetchone()
+        return row[0]
+
+async def old_create_offer(request_id, executor_id, rate_type, rate_value, comment):
+    async with aiosqlite.connect(bb.DB_PATH) as db:
+        await db.execute(
+            "INSERT INTO offers(request_id, executor_id, rate_type, rate_value, comment, status, created_at) "
+            "VALUES(?,?,?,?,?,'active','')",
+            (request_id, executor_id, rate_type, rate_value, comment)
+        )
+        await db.commit()
+        cur = await db.execute("SELECT last_insert_rowid()")
+        return (await cur.fetchone())[0]
+
+
+async def seed():
+    tg = SimpleNamespace(id=1001, username="bench_client", first_name="B", last_name="C")
+    uid = await bb.get_or_create_user(tg, role="client")
+    ex_id = await bb.admin_add_executor("bench_exec", "Москва", 50, ["Экскаватор"], True)
+    await bb.set_executor_location(ex_id, 55.75, 37.61)
+    req_id = await bb.new_request(uid, "Экскаватор", "bench", "addr", "", 55.76, 37.62, 100, "auction")
+    return tg, uid, ex_id, req_id
+
+
+async def timed(label, fn, iters):
+    t0 = time.perf_counter()
+    for _ in range(iters):
+        await fn()
+    dt = time.perf_counter() - t0
+    return label, dt / iters * 1e6
+
+
+async def main(iters: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        bb.DB_PATH = os.path.join(tmp, "bench.db")
+        await bb.db_init()
+        tg, uid, ex_id, req_id = await seed()
+        cases = [
+            ("get_request", lambda: old_get_request(req_id), lambda: bb.get_request(req_id)),
+            ("get_executor", lambda: old_get_executor(ex_id), lambda: bb.get_executor(ex_id)),
+            ("users.tg_id by id", lambda: old_tg_id_by_user_id(uid),
+             lambda: bb.DB.fetchone("SELECT tg_id FROM users WHERE id=?", (uid,))),
+            ("settings_get", old_settings_get, bb.settings_get),
+            ("get_or_create_user (known)", lambda: old_get_or_create_user(tg), lambda: bb.get_or_create_user(tg)),
+            ("offers insert", lambda: old_create_offer(req_id, ex_id, "час", 1.0, ""),
+             lambda: bb.DB.execute(
+                 "INSERT INTO offers(request_id, executor_id, rate_type, rate_value, comment, status, created_at) "
+                 "VALUES(?,?,?,?,?,'active','')", (req_id, ex_id, "час", 1.0, ""))),
+        ]
+        print(f"{'helper':<28}{'old us/call':>14}{'pooled us/call':>16}{'speedup':>10}")
+        for name, old, new in cases:
+            _, t_old = await timed(name, old, iters)
+            _, t_new = await timed(name, new, iters)
+            print(f"{name:<28}{t_old:>14.1f}{t_new:>16.1f}{t_old / t_new:>9.1f}x")
+        await bb.db_close()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--iters", type=int, default=500)
+    asyncio.run(main(ap.parse_args().iters))
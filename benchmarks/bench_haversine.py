@@ -0,0 +1,52 @@
+# Candidate distance filter: per-row haversine_km loop vs haversine_batch (NumPy and pure Python).
+#   python -m benchmarks.bench_haversine [--sizes 1000 10000 100000] [--repeat 5]
+import argparse
+import random
+import time
+
+import broker_bot as bb
+
+
+def loop_filter(lat, lon, lats, lons, radii, max_km):
+    out = []
+    for elat, elon, er in zip(lats, lons, radii):
+        d = bb.haversine_km(lat, lon, elat, elon)
+        out.append((d, d <= er and d <= max_km))
+    return out
+
+
+def best_of(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best * 1e3
+
+
+def main(sizes, repeat):
+    rnd = random.Random(42)
+    lat, lon, max_km = 55.75, 37.62, 300.0
+    has_np = bb.np is not None
+    print(f"numpy: {'yes ' + bb.np.__version__ if has_np else 'not installed'}")
+    print(f"{'executors':>10}{'loop ms':>10}{'pure ms':>10}{'numpy ms':>10}{'best speedup':>14}")
+    for n in sizes:
+        lats = [rnd.uniform(50, 60) for _ in range(n)]
+        lons = [rnd.uniform(30, 45) for _ in range(n)]
+        radii = [rnd.uniform(10, 300) for _ in range(n)]
+        t_loop = best_of(lambda: loop_filter(lat, lon, lats, lons, radii, max_km), repeat)
+        saved, bb.np = bb.np, None
+        t_pure = best_of(lambda: bb.haversine_batch(lat, lon, lats, lons, radii, max_km), repeat)
+        bb.np = saved
+        t_np = best_of(lambda: bb.haversine_batch(lat, lon, lats, lons, radii, max_km), repeat) if has_np else None
+        best = min(t_pure, t_np) if t_np is not None else t_pure
+        np_col = f"{t_np:>10.2f}" if t_np is not None else f"{'-':>10}"
+        print(f"{n:>10}{t_loop:>10.2f}{t_pure:>10.2f}{np_col}{t_loop / best:>13.1f}x")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    ap.add_argument("--repeat", type=int, default=5)
+    args = ap.parse_args()
+    main(args.sizes, args.repeat)
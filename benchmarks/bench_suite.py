@@ -0,0 +1,171 @@
+# Latency suite for the matching and DB layer on a generated dataset (benchmarks.datagen).
+# Writes a JSON result file (commit, environment, scale, per-operation percentiles) and can
+# compare against an earlier one; exits 1 if any operation's p50 regressed past --threshold.
+#   python -m benchmarks.bench_suite [--scale medium] [--iters 500] [--out results.json]
+#   python -m benchmarks.bench_suite --compare bench-results/old.json
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from types import SimpleNamespace
+
+import broker_bot as bb
+from benchmarks import datagen
+from benchmarks.check_plans import fake_callback
+
+
+def percentile(sorted_vals, q):
+    if not sorted_vals:
+        return 0.0
+    k = min(len(sorted_vals) - 1, max(0, round(q * (len(sorted_vals) - 1))))
+    return sorted_vals[k]
+
+
+async def measure(fn, args_list, warmup: int = 20) -> dict:
+    for args in args_list[:warmup]:
+        await fn(*args)
+    lat = []
+    t_all = time.perf_counter()
+    for args in args_list:
+        t0 = time.perf_counter()
+        await fn(*args)
+        lat.append((time.perf_counter() - t0) * 1e6)
+    wall = time.perf_counter() - t_all
+    lat.sort()
+    return {
+        "n": len(lat),
+        "mean_us": round(statistics.fmean(lat), 1),
+        "p50_us": round(percentile(lat, 0.5), 1),
+        "p95_us": round(percentile(lat, 0.95), 1),
+        "p99_us": round(percentile(lat, 0.99), 1),
+        "max_us": round(lat[-1], 1),
+        "ops_s": round(len(lat) / wall, 1),
+    }
+
+
+async def find_candidates_sql(req_id):
+    loaded, bb.MATCHER.loaded = bb.MATCHER.loaded, False
+    try:
+        return await bb.find_candidates(req_id)
+    finally:
+        bb.MATCHER.loaded = loaded
+
+
+async def get_or_create_user_cold(tg):
+    bb.USER_IDS.invalidate(tg.id)
+    return await bb.get_or_create_user(tg, role="client")
+
+
+async def cmd_my_inline(tg):
+    await bb.cmd_my_inline(*fake_callback(tg, "imenu:my"))
+
+
+async def run_suite(scale: dict, iters: int, rnd: random.Random) -> dict:
+    tg = lambda uid: SimpleNamespace(id=datagen.TG_ID_BASE + uid, username=f"user{uid}", first_name=f"U{uid}", last_name=None)
+    req_ids = [(rnd.randint(1, scale["requests"]),) for _ in range(iters)]
+    client_ids = [r[0] for r in await bb.DB.fetchall("SELECT DISTINCT client_user_id FROM requests ORDER BY 1")]
+    clients = [(tg(rnd.choice(client_ids)),) for _ in range(iters)]
+    newcomers = [(SimpleNamespace(id=datagen.TG_ID_BASE * 3 + i, username=f"new{i}", first_name="N", last_name=None),)
+                 for i in range(iters)]
+    free = [r[0] for r in await bb.DB.fetchall(
+        "SELECT o.id FROM offers o WHERE NOT EXISTS (SELECT 1 FROM deals d WHERE d.offer_id=o.id) "
+        "ORDER BY o.id LIMIT ?", (iters,))]
+    fresh_offers = [(oid,) for oid in free]
+    results = {}
+    results["find_candidates"] = await measure(bb.find_candidates, req_ids)
+    results["find_candidates_sql"] = await measure(find_candidates_sql, req_ids)
+    results["get_or_create_user_cached"] = await measure(bb.get_or_create_user, clients, warmup=len(clients))
+    results["get_or_create_user_upsert"] = await measure(get_or_create_user_cold, clients)
+    results["get_or_create_user_new"] = await measure(bb.get_or_create_user, newcomers, warmup=0)
+    results["cmd_my_inline"] = await measure(cmd_my_inline, clients)
+    results["get_offers_by_request"] = await measure(bb.get_offers_by_request, req_ids)
+    results["accept_offer_new"] = await measure(bb.accept_offer, fresh_offers, warmup=0)
+    results["accept_offer_repeat"] = await measure(bb.accept_offer, fresh_offers, warmup=0)
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(old: dict, new: dict, threshold: float) -> int:
+    regressions = 0
+    print(f"\ncompared with {old.get('commit', '?')} ({old.get('timestamp', '?')}):")
+    print(f"{'operation':<28}{'old p50':>10}{'new p50':>10}{'delta':>9}")
+    for op, res in new["results"].items():
+        prev = old.get("results", {}).get(op)
+        if not prev or not prev["p50_us"]:
+            print(f"{op:<28}{'-':>10}{res['p50_us']:>10.1f}{'new':>9}")
+            continue
+        delta = res["p50_us"] / prev["p50_us"] - 1
+        flag = ""
+        if delta > threshold:
+            regressions += 1
+            flag = "  REGRESSION"
+        print(f"{op:<28}{prev['p50_us']:>10.1f}{res['p50_us']:>10.1f}{delta:>+9.0%}{flag}")
+    if old.get("scale") != new["scale"]:
+        print("note: the two runs used different scales")
+    return regressions
+
+
+async def main(args) -> int:
+    scale = datagen.scale_from_args(args)
+    with tempfile.TemporaryDirectory() as tmp:
+        bb.DB_PATH = os.path.join(tmp, "bench.db")
+        await bb.db_init()
+        try:
+            t0 = time.perf_counter()
+            summary = await datagen.generate(seed=args.seed, **scale)
+            gen_s = time.perf_counter() - t0
+            results = await run_suite(scale, args.iters, random.Random(args.seed))
+        finally:
+            await bb.db_close()
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.utcnow().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "numpy": bb.np.__version__ if bb.np is not None else None,
+        "scale": scale,
+        "dataset": summary,
+        "iters": args.iters,
+        "generate_s": round(gen_s, 2),
+        "results": results,
+    }
+    print("dataset: " + ", ".join(f"{k} {v}" for k, v in summary.items()) + f" (generated in {gen_s:.1f} s)")
+    print(f"{'operation':<28}{'p50 us':>10}{'p95 us':>10}{'p99 us':>10}{'ops/s':>10}")
+    for op, r in results.items():
+        print(f"{op:<28}{r['p50_us']:>10.1f}{r['p95_us']:>10.1f}{r['p99_us']:>10.1f}{r['ops_s']:>10.0f}")
+    out = args.out or os.path.join("bench-results", f"{report['timestamp'].replace(':', '')}-{report['commit']}.json")
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"results written to {out}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            if compare(json.load(f), report, args.threshold):
+                return 1
+    return 0
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    datagen.add_scale_args(ap)
+    ap.add_argument("--iters", type=int, default=500)
+    ap.add_argument("--out", help="result file (default bench-results/<timestamp>-<commit>.json)")
+    ap.add_argument("--compare", help="earlier result file to compare p50 latencies against")
+    ap.add_argument("--threshold", type=float, default=0.25, help="p50 slowdown counted as a regression")
+    sys.exit(asyncio.run(main(ap.parse_args())))
@@ -0,0 +1,144 @@
+# EXPLAIN QUERY PLAN audit of the hot SQL in broker_bot.
+#
+# Seeds a temporary broker.db, traces every statement the hot helpers and handlers actually
+# execute (so the audited SQL cannot drift from the code), and runs EXPLAIN QUERY PLAN on
+# each one. Exits with status 1 if any statement plans a full table SCAN, so it can gate CI:
+#   python -m benchmarks.check_plans [-v]
+import argparse
+import asyncio
+import os
+import re
+import sys
+import tempfile
+from types import SimpleNamespace
+
+import broker_bot as bb
+
+# R*Tree lookups show up as "SCAN <alias> VIRTUAL TABLE INDEX n:..." and are index searches
+ALLOWED_SCAN = re.compile(r"VIRTUAL TABLE INDEX \d+:\S")
+# control statements, trigger sub-statements ("-- ...") and R*Tree shadow-table maintenance
+SKIP = re.compile(r"^\s*(--|(PRAGMA|BEGIN|COMMIT|ROLLBACK|EXPLAIN|SAVEPOINT|RELEASE)\b)|'main'\.'\w+_(node|rowid|parent)'", re.I)
+
+
+class _Msg:
+    async def reply_text(self, *a, **kw):
+        return self
+
+    async def edit_text(self, *a, **kw):
+        return self
+
+
+class _Bot:
+    async def send_message(self, *a, **kw):
+        return None
+
+
+def fake_callback(tg_user, data):
+    q = SimpleNamespace(data=data, message=_Msg(), answer=lambda *a, **kw: asyncio.sleep(0))
+    update = SimpleNamespace(effective_user=tg_user, callback_query=q, message=None,
+                             effective_chat=SimpleNamespace(id=tg_user.id))
+    context = SimpleNamespace(bot=_Bot(), user_data={}, args=[],
+                              application=SimpleNamespace(create_task=lambda coro, **kw: asyncio.ensure_future(coro)))
+    return update, context
+
+
+async def seed():
+    client = SimpleNamespace(id=9001, username="plan_client", first_name="P", last_name=None)
+    uid = await bb.get_or_create_user(client, role="client")
+    execs = []
+    for i, cat in enumerate(bb.CATEGORY_CHOICES):
+        eid = await bb.admin_add_executor(f"exec{i}", "Москва", 100, [cat, bb.CATEGORY_CHOICES[0]], i % 2 == 0,
+                                          direct_tg_id=8000 + i)
+        await bb.set_executor_location(eid, 55.7 + i / 100, 37.6)
+        execs.append(eid)
+    req_id = await bb.new_request(uid, bb.CATEGORY_CHOICES[0], "d", "a", "", 55.75, 37.6, 200, "auction")
+    offer_id = await bb.create_offer_notify(req_id, execs[0], "час", 10, "")
+    return client, uid, execs, req_id, offer_id
+
+
+async def hot_path(client, uid, execs, req_id, offer_id):
+    # every call here is on a per-update path of the bot
+    newcomer = SimpleNamespace(id=9002, username="exec1", first_name=None, last_name=None)
+    await bb.get_or_create_user(newcomer)
+    await bb.get_or_create_user(client, role="client")
+    await bb.get_request(req_id)
+    await bb.get_executor(execs[0])
+    await bb.get_offers_by_request(req_id)
+    await bb.chat_ids_by_user_ids([uid])
+    await bb.chat_ids_by_executor_ids(execs)
+    await bb.GEOCACHE.get("москва, тверская 1")
+    await bb.set_executor_location(execs[1], 55.8, 37.7)
+    await bb.set_executor_active(execs[2], True)
+    await bb.find_candidates(req_id)
+    loaded, bb.MATCHER.loaded = bb.MATCHER.loaded, False
+    try:
+        await bb.find_candidates(req_id)  # SQL matching path
+    finally:
+        bb.MATCHER.loaded = loaded
+    await bb.cmd_my_inline(*fake_callback(client, "imenu:my"))
+    await bb.on_view_offers(*fake_callback(client, f"view_offers:{req_id}"))
+    await bb.on_view_offers(*fake_callback(client, f"offers:{req_id}:older:{offer_id + 1}"))
+    await bb.on_view_offers(*fake_callback(client, f"offers:{req_id}:newer:0"))
+    await bb.on_my_page(*fake_callback(client, f"my:older:{req_id + 1}"))
+    await bb.on_my_page(*fake_callback(client, "my:newer:0"))
+    await bb.on_accept_offer(*fake_callback(client, f"accept_offer:{offer_id}"))
+    for f in ({}, {"city": "Москва"}, {"cat": bb.CATEGORY_CHOICES[0], "owner": True, "active": True}):
+        await bb.admin_executors_page(f, limit=2)  # /admin list_exec and its pager buttons
+        await bb.admin_executors_page(f, execs[-1], limit=2)
+        await bb.admin_executors_page(f, execs[0], newer=True, limit=2)
+    candidates = await bb.find_matches(bb.CATEGORY_CHOICES[0], 55.75, 37.6, 200)
+    new_req, _ = await bb.create_auction_request(uid, bb.CATEGORY_CHOICES[0], "d", "a", 55.75, 37.6, 200, candidates)
+    window, bb.OFFER_DIGEST_WINDOW = bb.OFFER_DIGEST_WINDOW, 0
+    try:
+        for eid in execs[:2]:
+            await bb.create_offer_notify(new_req, eid, "час", 10, "")  # coalesced into a digest
+    finally:
+        bb.OFFER_DIGEST_WINDOW = window
+    await bb.OUTBOX.drain_once(_Bot())
+    await bb.OUTBOX.report(new_req)
+    await bb.OUTBOX._next_due()
+
+
+async def traced_statements(seeded) -> list:
+    seen = []
+    conns = [bb.DB.writer, *bb.DB._readers]
+    for c in conns:
+        await c.set_trace_callback(seen.append)
+    try:
+        await hot_path(*seeded)
+    finally:
+        for c in conns:
+            await c.set_trace_callback(None)
+    out = []
+    for sql in seen:
+        if not SKIP.search(sql) and sql not in out:
+            out.append(sql)
+    return out
+
+
+async def audit(verbose: bool = False) -> int:
+    with tempfile.TemporaryDirectory() as tmp:
+        bb.DB_PATH = os.path.join(tmp, "plans.db")
+        await bb.db_init()
+        try:
+            seeded = await seed()
+            failures = 0
+            for sql in await traced_statements(seeded):
+                plan = [r[3] for r in await bb.DB.fetchall("EXPLAIN QUERY PLAN " + sql)]
+                bad = [p for p in plan if p.startswith("SCAN") and not ALLOWED_SCAN.search(p)]
+                if bad:
+                    failures += 1
+                if bad or verbose:
+                    print(("FAIL " if bad else "ok   ") + " ".join(sql.split()))
+                    for p in plan:
+                        print("       " + p)
+        finally:
+            await bb.db_close()
+    print(f"{failures} statement(s) with full scans" if failures else "query plans OK")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-v", "--verbose", action="store_true")
+    sys.exit(asyncio.run(audit(ap.parse_args().verbose)))
@@ -0,0 +1,157 @@
+# Seeded synthetic dataset for broker.db: users, executors spread over cities (radii, categories
+# from CATEGORY_CHOICES, owners, inactive, linked / direct / pending contacts), requests, offers
+# and deals. The same --seed and scale always produce the same database.
+#   python -m benchmarks.datagen [--db broker.db] [--scale small|medium|large] [--executors N] ... [--force]
+import argparse
+import asyncio
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+
+import broker_bot as bb
+
+CITIES = [
+    ("Москва", 55.7558, 37.6173, 0.35), ("Санкт-Петербург", 59.9343, 30.3351, 0.25),
+    ("Новосибирск", 55.0084, 82.9357, 0.15), ("Екатеринбург", 56.8389, 60.6057, 0.15),
+    ("Казань", 55.7961, 49.1064, 0.12), ("Нижний Новгород", 56.2965, 43.9361, 0.12),
+    ("Челябинск", 55.1644, 61.4368, 0.1), ("Самара", 53.1959, 50.1002, 0.1),
+    ("Ростов-на-Дону", 47.2357, 39.7015, 0.1), ("Краснодар", 45.0355, 38.9753, 0.1),
+    ("Воронеж", 51.6608, 39.2003, 0.08), ("Пермь", 58.0105, 56.2502, 0.08),
+]
+# most of the load sits in the big cities
+CITY_WEIGHTS = [30, 18, 6, 6, 5, 5, 4, 4, 5, 6, 3, 3]
+RADII = [10, 20, 30, 50, 50, 80, 100, 150]
+SCALES = {
+    "small": dict(users=2000, executors=500, requests=2000, offers=3.0),
+    "medium": dict(users=20000, executors=5000, requests=20000, offers=4.0),
+    "large": dict(users=100000, executors=30000, requests=100000, offers=5.0),
+}
+TG_ID_BASE = 10_000_000
+BATCH = 5000
+
+
+def _point(rnd, city):
+    _, lat, lon, spread = city
+    return lat + rnd.gauss(0, spread), lon + rnd.gauss(0, spread * 1.6)
+
+
+async def _insert(sql, rows):
+    for i in range(0, len(rows), BATCH):
+        async with bb.DB.transaction() as db:
+            await db.executemany(sql, rows[i:i + BATCH])
+
+
+async def generate(users: int, executors: int, requests: int, offers: float, seed: int = 42) -> dict:
+    # bb.DB must be open (bb.db_init()); ids are assigned explicitly so the data is reproducible
+    rnd = random.Random(seed)
+    t0 = datetime(2025, 1, 1)
+    n_exec_users = min(users // 2, int(executors * 0.7))
+    exec_user_ids = list(range(1, n_exec_users + 1))
+    client_ids = list(range(n_exec_users + 1, users + 1)) or exec_user_ids
+
+    await _insert(
+        "INSERT INTO users(id, tg_id, username, first_name, last_name, role) VALUES(?,?,?,?,?,?)",
+        [(uid, TG_ID_BASE + uid, f"user{uid}", f"U{uid}", None, "executor" if uid <= n_exec_users else "client")
+         for uid in range(1, users + 1)])
+
+    exec_rows, cat_rows = [], []
+    for eid in range(1, executors + 1):
+        city = rnd.choices(CITIES, CITY_WEIGHTS)[0]
+        lat, lon = _point(rnd, city)
+        cats = rnd.sample(bb.CATEGORY_CHOICES, rnd.choice((1, 1, 2, 2, 3)))
+        # linked user / direct tg_id / waiting for @username to /start
+        if eid <= n_exec_users:
+            user_id, pending, direct = exec_user_ids[eid - 1], None, None
+        elif rnd.random() < 0.6:
+            user_id, pending, direct = None, None, TG_ID_BASE * 2 + eid
+        else:
+            user_id, pending, direct = None, f"pending{eid}", None
+        located = rnd.random() < 0.97
+        exec_rows.append((eid, user_id, pending, direct, ",".join(cats), city[0],
+                          lat if located else None, lon if located else None, rnd.choice(RADII),
+                          1 if rnd.random() < 0.1 else 0, 0 if rnd.random() < 0.05 else 1,
+                          (t0 + timedelta(minutes=eid)).isoformat()))
+        cat_rows += [(eid, c) for c in cats]
+    await _insert(
+        "INSERT INTO executors(id, user_id, pending_username, direct_tg_id, categories, city, lat, lon, radius_km, "
+        "is_owner, is_active, created_at) VALUES(?,?,?,?,?,?,?,?,?,?,?,?)", exec_rows)
+    await _insert("INSERT INTO executor_categories(executor_id, category) VALUES(?,?)", cat_rows)
+
+    req_rows, offer_rows, deal_rows = [], [], []
+    oid = 0
+    for rid in range(1, requests + 1):
+        city = rnd.choices(CITIES, CITY_WEIGHTS)[0]
+        lat, lon = _point(rnd, city)
+        created = t0 + timedelta(minutes=3 * rid)
+        mode = "auction" if rnd.random() < 0.8 else "catalog"
+        req_rows.append((rid, rnd.choice(client_ids), rnd.choice(bb.CATEGORY_CHOICES), f"Заявка {rid}",
+                         f"{city[0]}, ул. Тестовая, {rnd.randint(1, 200)}", city[0], lat, lon,
+                         rnd.choice(RADII), mode, "published", created.isoformat()))
+        n_off = min(executors, int(rnd.expovariate(1 / offers))) if offers > 0 else 0
+        accepted = rnd.random() < 0.1
+        for k, eid in enumerate(rnd.sample(range(1, executors + 1), n_off)):
+            oid += 1
+            status = "accepted" if accepted and k == 0 else "active"
+            ts = (created + timedelta(minutes=k + 1)).isoformat()
+            offer_rows.append((oid, rid, eid, rnd.choice(("час", "смена", "объект")),
+                               float(rnd.randrange(1000, 50000, 500)), "", status, ts))
+            if status == "accepted":
+                deal_rows.append((rid, oid, 1, ts))
+    await _insert(
+        "INSERT INTO requests(id, client_user_id, category, description, address_text, city, lat, lon, "
+        "client_radius_km, mode, status, created_at) VALUES(?,?,?,?,?,?,?,?,?,?,?,?)", req_rows)
+    await _insert(
+        "INSERT INTO offers(id, request_id, executor_id, rate_type, rate_value, comment, status, created_at) "
+        "VALUES(?,?,?,?,?,?,?,?)", offer_rows)
+    await _insert("INSERT INTO deals(request_id, offer_id, contacts_released, created_at) VALUES(?,?,?,?)", deal_rows)
+
+    async with bb.DB.transaction() as db:
+        await db.execute("ANALYZE")
+    for cache in bb.REF_CACHES:
+        cache.invalidate()
+    await bb.MATCHER.load()
+    return {"users": users, "executors": executors, "requests": requests, "offers": len(offer_rows),
+            "deals": len(deal_rows), "seed": seed}
+
+
+def add_scale_args(ap: argparse.ArgumentParser):
+    ap.add_argument("--scale", choices=sorted(SCALES), default="small")
+    ap.add_argument("--users", type=int)
+    ap.add_argument("--executors", type=int)
+    ap.add_argument("--requests", type=int)
+    ap.add_argument("--offers", type=float, help="mean offers per request")
+    ap.add_argument("--seed", type=int, default=42)
+
+
+def scale_from_args(args) -> dict:
+    scale = dict(SCALES[args.scale])
+    for k in scale:
+        if getattr(args, k) is not None:
+            scale[k] = getattr(args, k)
+    return scale
+
+
+async def main(args) -> int:
+    if os.path.exists(args.db) and not args.force:
+        print(f"{args.db} already exists; pass --force to replace it", file=sys.stderr)
+        return 2
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(args.db + suffix):
+            os.remove(args.db + suffix)
+    bb.DB_PATH = args.db
+    await bb.db_init()
+    try:
+        summary = await generate(seed=args.seed, **scale_from_args(args))
+    finally:
+        await bb.db_close()
+    print(f"{args.db}: " + ", ".join(f"{k} {v}" for k, v in summary.items()))
+    return 0
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--db", default=bb.DB_PATH)
+    ap.add_argument("--force", action="store_true", help="delete an existing database first")
+    add_scale_args(ap)
+    sys.exit(asyncio.run(main(ap.parse_args())))
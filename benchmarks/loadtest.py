@@ -0,0 +1,405 @@
+# End-to-end load test: build_app() against a local stand-in for the Telegram Bot API.
+#
+# The stub records every Bot API call (sendMessage, editMessageText, ...), can answer
+# sendMessage/editMessageText with 429 RetryAfter (randomly and/or above --api-rps), and also
+# serves a Nominatim-like geocoder. Simulated clients run the whole flow through the update
+# queue (new request -> mode -> category -> description -> address -> geocode pick -> radius ->
+# auction fan-out -> offer -> accept); simulated executors answer the broadcasts they receive.
+# Reports throughput, p50/p95/p99 handler latency per step and outbound call counts.
+#   python -m benchmarks.loadtest [--clients 200] [--rate 20] [--executors 2000] [--p429 0.01] [--out report.json]
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import TypeHandler
+
+import broker_bot as bb
+from benchmarks import datagen
+from benchmarks.bench_suite import git_commit, percentile
+
+CLIENT_TG_BASE = datagen.TG_ID_BASE * 4
+BOT_USER = {"id": 4242, "is_bot": True, "first_name": "Broker", "username": "broker_load_bot"}
+
+
+class FakeBotAPI:
+    # /bot<token>/<method> like api.telegram.org, plus GET /geocode like Nominatim /search
+    def __init__(self, rnd: random.Random, p429: float, api_rps: float):
+        self.rnd = rnd
+        self.p429 = p429
+        self.api_rps = api_rps
+        self.calls = Counter()
+        self.throttled = Counter()
+        self.geocode_calls = 0
+        self.chats = defaultdict(ChatLog)
+        self._ids = itertools.count(1000)
+        self._window = (0, 0)  # (second, calls in it) for --api-rps
+
+    def _limited(self) -> bool:
+        if self.rnd.random() < self.p429:
+            return True
+        if self.api_rps:
+            sec = int(time.monotonic())
+            n = self._window[1] + 1 if self._window[0] == sec else 1
+            self._window = (sec, n)
+            return n > self.api_rps
+        return False
+
+    async def on_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        self.calls[method] += 1
+        if method in ("sendMessage", "editMessageText") and self._limited():
+            self.throttled[method] += 1
+            return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                      "parameters": {"retry_after": 1}}, status=429)
+        if method == "getMe":
+            result = BOT_USER
+        elif method in ("sendMessage", "editMessageText"):
+            chat_id = int(params["chat_id"])
+            markup = params.get("reply_markup")
+            markup = json.loads(markup) if isinstance(markup, str) else markup
+            mid = int(params["message_id"]) if method == "editMessageText" else next(self._ids)
+            result = {"message_id": mid, "date": int(time.time()), "from": BOT_USER,
+                      "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}
+            if markup:
+                result["reply_markup"] = markup
+            self.chats[chat_id].add(mid, markup)
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def on_geocode(self, request: web.Request) -> web.Response:
+        self.geocode_calls += 1
+        q = request.query.get("q", "")
+        city = next((c for c in datagen.CITIES if c[0] in q), datagen.CITIES[0])
+        rnd = random.Random(q)
+        return web.json_response([
+            {"display_name": f"{q} ({i + 1})", "lat": str(city[1] + rnd.gauss(0, 0.05)), "lon": str(city[2] + rnd.gauss(0, 0.08))}
+            for i in range(3)
+        ])
+
+    def app(self) -> web.Application:
+        webapp = web.Application()
+        webapp.router.add_post("/bot{token}/{method}", self.on_method)
+        webapp.router.add_get("/geocode", self.on_geocode)
+        return webapp
+
+
+class ChatLog:
+    # what the bot has shown in one chat: callback_data of every button, newest last
+    def __init__(self):
+        self.buttons = []  # (message_id, callback_data)
+        self.changed = asyncio.Event()
+        self.listener = None
+
+    def add(self, mid, markup):
+        for row in (markup or {}).get("inline_keyboard", []):
+            for b in row:
+                if "callback_data" in b:
+                    self.buttons.append((mid, b["callback_data"]))
+        self.changed.set()
+        if self.listener is not None:
+            self.listener(self)
+
+    async def wait_button(self, prefix: str, start: int, timeout: float):
+        # first button with the prefix shown at or after index `start`; returns (index, mid, data)
+        deadline = time.monotonic() + timeout
+        while True:
+            for i in range(start, len(self.buttons)):
+                mid, data = self.buttons[i]
+                if data.startswith(prefix):
+                    return i, mid, data
+            self.changed.clear()
+            left = deadline - time.monotonic()
+            if left <= 0:
+                raise asyncio.TimeoutError(prefix)
+            try:
+                await asyncio.wait_for(self.changed.wait(), left)
+            except asyncio.TimeoutError:
+                pass
+
+
+class Driver:
+    # feeds updates into application.update_queue and times them: group -2 marks the start of
+    # handling (after the per-user queue), group 1000 the end
+    def __init__(self, application):
+        self.app = application
+        self.ids = itertools.count(1)
+        self.pending = {}  # update_id -> [label, enqueued, started, future]
+        self.latency = defaultdict(list)  # label -> handler ms
+        self.e2e = defaultdict(list)  # label -> enqueue-to-done ms
+        application.add_handler(TypeHandler(Update, self._started), group=-2)
+        application.add_handler(TypeHandler(Update, self._done), group=1000)
+
+    async def _started(self, update, context):
+        p = self.pending.get(update.update_id)
+        if p:
+            p[2] = time.perf_counter()
+
+    async def _done(self, update, context):
+        p = self.pending.pop(update.update_id, None)
+        if p:
+            label, enq, started, fut = p
+            now = time.perf_counter()
+            self.latency[label].append((now - (started or enq)) * 1000)
+            self.e2e[label].append((now - enq) * 1000)
+            if not fut.done():
+                fut.set_result(None)
+
+    async def _put(self, label, data):
+        uid = next(self.ids)
+        data["update_id"] = uid
+        fut = asyncio.get_running_loop().create_future()
+        self.pending[uid] = [label, time.perf_counter(), None, fut]
+        await self.app.update_queue.put(Update.de_json(data, self.app.bot))
+        await fut
+
+    @staticmethod
+    def _user(tg_id):
+        return {"id": tg_id, "is_bot": False, "first_name": f"L{tg_id}", "username": f"load{tg_id}"}
+
+    async def text(self, label, tg_id, text):
+        await self._put(label, {"message": {"message_id": next(self.ids), "date": int(time.time()), "text": text,
+                                            "chat": {"id": tg_id, "type": "private"}, "from": self._user(tg_id)}})
+
+    async def click(self, label, tg_id, mid, data):
+        await self._put(label, {"callback_query": {
+            "id": str(next(self.ids)), "chat_instance": str(tg_id), "data": data, "from": self._user(tg_id),
+            "message": {"message_id": mid, "date": int(time.time()), "chat": {"id": tg_id, "type": "private"},
+                        "from": BOT_USER, "text": ""}}})
+
+
+async def client_session(drv: Driver, api: FakeBotAPI, tg_id: int, rnd: random.Random, args, stats: Counter, ttfo: list):
+    chat = api.chats[tg_id]
+    step = "start"
+    t0 = time.perf_counter()
+    try:
+        step = "imenu:new"
+        await drv.click(step, tg_id, 1, "imenu:new")
+        i, mid, _ = await chat.wait_button("mode:", 0, args.step_timeout)
+        step = "mode"
+        await drv.click(step, tg_id, mid, "mode:auction")
+        i, mid, _ = await chat.wait_button("cat:", i + 1, args.step_timeout)
+        step = "category"
+        await drv.click(step, tg_id, mid, f"cat:{rnd.randrange(len(bb.CATEGORY_CHOICES))}")
+        step = "description"
+        await asyncio.sleep(args.think)
+        await drv.text(step, tg_id, f"Нужна техника, заявка нагрузочного теста {tg_id}")
+        city = rnd.choices(datagen.CITIES, datagen.CITY_WEIGHTS)[0][0]
+        step = "address"
+        await asyncio.sleep(args.think)
+        await drv.text(step, tg_id, f"{city}, ул. Нагрузочная, {rnd.randrange(args.addresses)}")
+        i, mid, _ = await chat.wait_button("geo_pick:", i + 1, args.step_timeout)
+        step = "geo_pick"
+        await drv.click(step, tg_id, mid, "geo_pick:0")
+        step = "radius"
+        await asyncio.sleep(args.think)
+        await drv.text(step, tg_id, str(rnd.choice((30, 50, 80))))
+        t_req = time.perf_counter()
+        step = "wait_offer"
+        try:
+            i, mid, data = await chat.wait_button("accept_offer:", i + 1, args.offer_timeout)
+        except asyncio.TimeoutError:
+            stats["no_offer"] += 1
+            return
+        ttfo.append((time.perf_counter() - t_req) * 1000)
+        step = "accept"
+        await drv.click(step, tg_id, mid, data)
+        stats["completed"] += 1
+    except asyncio.TimeoutError:
+        stats[f"stuck:{step}"] += 1
+    finally:
+        stats["sessions"] += 1
+        drv.latency["session"].append((time.perf_counter() - t0) * 1000)
+
+
+class Executors:
+    # executors answer broadcasts ("offer:<req>:<exec>" buttons) with probability --offer-prob
+    def __init__(self, drv: Driver, rnd: random.Random, args, stats: Counter):
+        self.drv, self.rnd, self.args, self.stats = drv, rnd, args, stats
+        self.seen = defaultdict(int)
+        self.locks = defaultdict(asyncio.Lock)
+        self.tasks = set()
+
+    def listener(self, chat_id):
+        def on_change(chat: ChatLog):
+            for idx in range(self.seen[chat_id], len(chat.buttons)):
+                mid, data = chat.buttons[idx]
+                if data.startswith("offer:") and self.rnd.random() < self.args.offer_prob:
+                    t = asyncio.get_running_loop().create_task(self.answer(chat_id, chat, mid, data, idx))
+                    self.tasks.add(t)
+                    t.add_done_callback(self.tasks.discard)
+            self.seen[chat_id] = len(chat.buttons)
+        return on_change
+
+    async def answer(self, tg_id, chat, mid, data, idx):
+        async with self.locks[tg_id]:
+            try:
+                await self.drv.click("offer", tg_id, mid, data)
+                i, mid, _ = await chat.wait_button("rt:", idx + 1, self.args.step_timeout)
+                await self.drv.click("rate_type", tg_id, mid, "rt:смена")
+                await self.drv.text("rate_value", tg_id, str(self.rnd.randrange(5000, 50000, 500)))
+                await self.drv.text("offer_comment", tg_id, "Готовы выйти завтра")
+                self.stats["offers"] += 1
+            except asyncio.TimeoutError:
+                self.stats["offer_stuck"] += 1
+
+
+def summarize(values) -> dict:
+    v = sorted(values)
+    if not v:
+        return {"n": 0}
+    return {"n": len(v), "p50_ms": round(percentile(v, 0.5), 2), "p95_ms": round(percentile(v, 0.95), 2),
+            "p99_ms": round(percentile(v, 0.99), 2), "max_ms": round(v[-1], 2)}
+
+
+class _ErrorCounter(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+async def run(args) -> dict:
+    rnd = random.Random(args.seed)
+    api = FakeBotAPI(rnd, args.p429, args.api_rps)
+    runner = web.AppRunner(api.app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    base = "http://127.0.0.1:%d" % runner.addresses[0][1]
+
+    bb.TELEGRAM_API_URL = base
+    bb.GEOCODE_URL = base + "/geocode"
+    bb.BOT_TOKEN = "123456:LOADTEST"
+    bb.METRICS_PORT = 0
+    bb.TRACER.path = args.trace or ""
+    bb.GEOCODE_LIMITER = bb.TokenBucket(rate=args.geocode_rps)
+    if args.digest_window is not None:
+        bb.OFFER_DIGEST_WINDOW = args.digest_window
+    if args.tg_rps:
+        bb.BROADCASTER = bb.Broadcaster(rate=args.tg_rps, per_chat_rate=bb.BROADCASTER.per_chat_rate,
+                                        concurrency=bb.BROADCASTER.sem._value)
+    errors = _ErrorCounter()
+    logging.getLogger().addHandler(errors)
+    stats = Counter()
+    ttfo = []
+    with tempfile.TemporaryDirectory() as tmp:
+        bb.DB_PATH = os.path.join(tmp, "load.db")
+        await bb.db_init()
+        try:
+            await datagen.generate(users=args.executors, executors=args.executors, requests=0, offers=0, seed=args.seed)
+            # every executor's chat is driven by the simulated executors
+            execs = Executors(None, rnd, args, stats)
+            for (chat_id,) in await bb.DB.fetchall(
+                    f"SELECT {bb.EXEC_CHAT_ID_SQL} FROM executors e LEFT JOIN users u ON u.id=e.user_id "
+                    f"WHERE {bb.EXEC_CHAT_ID_SQL} IS NOT NULL"):
+                api.chats[chat_id].listener = execs.listener(chat_id)
+
+            application = bb.build_app()
+            drv = Driver(application)
+            execs.drv = drv
+            await application.initialize()
+            await application.post_init(application)
+            await application.start()
+            t0 = time.perf_counter()
+            sessions = []
+            for n in range(args.clients):
+                sessions.append(asyncio.create_task(
+                    client_session(drv, api, CLIENT_TG_BASE + n, random.Random(args.seed * 1000003 + n), args, stats, ttfo)))
+                await asyncio.sleep(1 / args.rate)
+            await asyncio.gather(*sessions)
+            elapsed = time.perf_counter() - t0
+            if execs.tasks:
+                await asyncio.wait(execs.tasks, timeout=args.step_timeout)
+            await application.stop()
+            await application.post_stop(application)
+            await application.shutdown()
+            await application.post_shutdown(application)
+        finally:
+            await bb.db_close()
+            await runner.cleanup()
+            logging.getLogger().removeHandler(errors)
+
+    updates = sum(len(v) for k, v in drv.latency.items() if k != "session")
+    all_handler = [x for k, v in drv.latency.items() if k != "session" for x in v]
+    return {
+        "commit": git_commit(),
+        "params": {k: v for k, v in vars(args).items() if k != "out"},
+        "elapsed_s": round(elapsed, 2),
+        "sessions": dict(stats),
+        "throughput": {"updates_s": round(updates / elapsed, 1), "sessions_s": round(stats["sessions"] / elapsed, 2)},
+        "handler_latency": {"all": summarize(all_handler),
+                            **{k: summarize(v) for k, v in drv.latency.items() if k != "session"}},
+        "e2e_latency": {k: summarize(v) for k, v in drv.e2e.items()},
+        "session_ms": summarize(drv.latency["session"]),
+        "time_to_first_offer_ms": summarize(ttfo),
+        "outbound_calls": dict(api.calls),
+        "throttled_429": dict(api.throttled),
+        "geocoder_calls": api.geocode_calls,
+        "handler_errors": errors.count,
+    }
+
+
+def print_report(r: dict):
+    print(f"{r['sessions'].get('sessions', 0)} sessions in {r['elapsed_s']} s: "
+          + ", ".join(f"{k} {v}" for k, v in sorted(r["sessions"].items()) if k != "sessions"))
+    print(f"throughput: {r['throughput']['updates_s']} updates/s, {r['throughput']['sessions_s']} sessions/s; "
+          f"handler errors: {r['handler_errors']}")
+    print(f"{'step':<16}{'n':>7}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'e2e p95':>9}")
+    for label, s in r["handler_latency"].items():
+        if s["n"]:
+            e2e = r["e2e_latency"].get(label, {}).get("p95_ms", "")
+            print(f"{label:<16}{s['n']:>7}{s['p50_ms']:>9}{s['p95_ms']:>9}{s['p99_ms']:>9}{e2e:>9}")
+    for name in ("session_ms", "time_to_first_offer_ms"):
+        s = r[name]
+        if s["n"]:
+            print(f"{name}: p50 {s['p50_ms']}, p95 {s['p95_ms']}, p99 {s['p99_ms']}")
+    print("outbound: " + ", ".join(f"{k} {v}" for k, v in sorted(r["outbound_calls"].items()))
+          + f"; 429 served: {sum(r['throttled_429'].values())}; geocoder calls: {r['geocoder_calls']}")
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--clients", type=int, default=200, help="client sessions to run")
+    ap.add_argument("--rate", type=float, default=20, help="new client sessions per second")
+    ap.add_argument("--executors", type=int, default=2000)
+    ap.add_argument("--offer-prob", type=float, default=0.3, help="chance an executor answers a broadcast")
+    ap.add_argument("--think", type=float, default=0.0, help="seconds a client waits before typing")
+    ap.add_argument("--addresses", type=int, default=50, help="distinct street numbers per city (geocode cache hits)")
+    ap.add_argument("--p429", type=float, default=0.01, help="chance a send/edit is answered with 429")
+    ap.add_argument("--api-rps", type=float, default=0, help="stub-side Bot API limit, 0 = none")
+    ap.add_argument("--tg-rps", type=float, default=0, help="override TG_GLOBAL_RPS of the broadcaster")
+    ap.add_argument("--geocode-rps", type=float, default=50)
+    ap.add_argument("--digest-window", type=float, help="override OFFER_DIGEST_WINDOW (seconds) of the bot")
+    ap.add_argument("--step-timeout", type=float, default=10)
+    ap.add_argument("--offer-timeout", type=float, default=30)
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--trace", help="also write the bot's per-update traces to this JSONL file")
+    ap.add_argument("--out", help="write the report as JSON")
+    ap.add_argument("-v", "--verbose", action="store_true", help="show the bot's log output")
+    args = ap.parse_args()
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    if not args.verbose:
+        # handler errors (e.g. a reply hit by a simulated 429) are still counted in the report
+        for h in logging.getLogger().handlers:
+            h.setLevel(logging.CRITICAL)
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"report written to {args.out}")
@@ -1,27 +1,86 @@
 
 import asyncio
+import functools
 import logging
 import aiosqlite
 import aiohttp
+import hmac
 import os
+import signal
+import sys
+import sqlite3
 import re
 import math
-from datetime import datetime
+import random
+import json
+import csv
+import io
+import tempfile
+import time
+import queue
+import logging.handlers
+import warnings
+from collections import Counter, OrderedDict, defaultdict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from pathlib import Path
 from typing import List, Optional, Tuple
 
+from aiohttp import web
 from dotenv import load_dotenv
+try:
+    import numpy as np
+except ImportError:  # optional; haversine_batch falls back to pure Python
+    np = None
 from telegram import (
     Update, InlineKeyboardMarkup, InlineKeyboardButton,
 )
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.request import HTTPXRequest
+from telegram.warnings import PTBUserWarning
 from telegram.ext import (
-    ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler,
-    ConversationHandler, ContextTypes, filters
+    ApplicationBuilder, BasePersistence, BaseUpdateProcessor, CommandHandler, MessageHandler, CallbackQueryHandler,
+    ConversationHandler, ContextTypes, PersistenceInput, TypeHandler, filters
 )
 
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_IDS = {int(x.strip()) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
 GEOCODE_UA = os.getenv("GEOCODE_UA", "tg-broker-bot/inline-only/1.0 (contact: set-your-email@example.com)")
+GEOCODE_URL = os.getenv("GEOCODE_URL", "https://nominatim.openstreetmap.org/search")
+# Bot API endpoint; point it at a local Bot API server (or the load-test stub in benchmarks.loadtest)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
+# polling (default) or webhook; webhook mode serves updates from an embedded aiohttp server
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # public base URL Telegram should call, e.g. https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8080")))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "16"))
+# outgoing notifications are queued in the outbox table and sent by a background worker
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "50"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_KEEP_DAYS = float(os.getenv("OUTBOX_KEEP_DAYS", "7"))
+# offers reaching one client within this many seconds are sent as a single digest; 0 sends on the next drain
+OFFER_DIGEST_WINDOW = float(os.getenv("OFFER_DIGEST_WINDOW", "10"))
+# Prometheus text metrics on http://METRICS_LISTEN:METRICS_PORT/metrics; 0 disables the listener
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+# per-update traces go to a rotating JSONL file (empty TRACE_FILE disables it); updates slower
+# than SLOW_UPDATE_MS are also logged with their span breakdown
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+TRACE_FILE_MB = float(os.getenv("TRACE_FILE_MB", "20"))
+TRACE_FILE_BACKUPS = int(os.getenv("TRACE_FILE_BACKUPS", "3"))
+TRACE_SAMPLE = float(os.getenv("TRACE_SAMPLE", "1"))
+SLOW_UPDATE_MS = float(os.getenv("SLOW_UPDATE_MS", "1000"))
+# conversation state and user_data are written to broker.db every PERSIST_INTERVAL seconds and on shutdown
+PERSIST_INTERVAL = float(os.getenv("PERSIST_INTERVAL", "30"))
+# a user idle for CONV_TIMEOUT seconds loses their half-finished dialogs and user_data
+CONV_TIMEOUT = float(os.getenv("CONV_TIMEOUT", "1800"))
+SWEEP_INTERVAL = float(os.getenv("SWEEP_INTERVAL", "60"))
 
 logging.basicConfig(level=logging.INFO)
 
@@ -51,32 +110,534 @@ def haversine_km(lat1, lon1, lat2, lon2):
     a = math.sin(dphi/2)**2 + math.cos(phi1)*math.cos(phi2)*math.sin(dlambda/2)**2
     return 2*R*math.asin(math.sqrt(a))
 
+HAVERSINE_NUMPY_MIN = 64  # below this the NumPy call overhead outweighs the vector math
+
+def haversine_batch(lat, lon, lats, lons, radii, max_km):
+    # distances from (lat, lon) to every point in one pass, plus the mask
+    # dist <= radii[i] and dist <= max_km; returns two plain lists
+    R = 6371.0
+    phi1 = math.radians(lat)
+    if np is not None and len(lats) >= HAVERSINE_NUMPY_MIN:
+        elat = np.asarray(lats, dtype=np.float64)
+        dphi = np.radians(elat - lat)
+        dlambda = np.radians(np.asarray(lons, dtype=np.float64) - lon)
+        a = np.sin(dphi/2)**2 + math.cos(phi1)*np.cos(np.radians(elat))*np.sin(dlambda/2)**2
+        d = 2*R*np.arcsin(np.sqrt(a))
+        mask = (d <= np.asarray(radii, dtype=np.float64)) & (d <= max_km)
+        return d.tolist(), mask.tolist()
+    sin, cos, asin, sqrt, radians = math.sin, math.cos, math.asin, math.sqrt, math.radians
+    cphi1 = cos(phi1)
+    dists, mask = [], []
+    for elat, elon, er in zip(lats, lons, radii):
+        a = sin(radians(elat - lat)/2)**2 + cphi1*cos(radians(elat))*sin(radians(elon - lon)/2)**2
+        d = 2*R*asin(sqrt(a))
+        dists.append(d)
+        mask.append(d <= er and d <= max_km)
+    return dists, mask
+
+KM_PER_DEG = 111.195
+
+def bbox_km(lat, lon, r_km):
+    # (min_lat, max_lat, min_lon, max_lon) enclosing a circle of r_km around the point, padded a bit;
+    # falls back to the full longitude range near the poles and across the antimeridian
+    dlat = r_km / KM_PER_DEG + 0.01
+    min_lat, max_lat = max(-90.0, lat - dlat), min(90.0, lat + dlat)
+    coslat = math.cos(math.radians(max(abs(min_lat), abs(max_lat))))
+    if coslat < 1e-6:
+        return min_lat, max_lat, -180.0, 180.0
+    dlon = r_km / (KM_PER_DEG * coslat) + 0.01
+    if lon - dlon < -180.0 or lon + dlon > 180.0:
+        return min_lat, max_lat, -180.0, 180.0
+    return min_lat, max_lat, lon - dlon, lon + dlon
+
 def is_admin(user_id: int) -> bool:
     return user_id in ADMIN_IDS
 
-async def geocode_address(q: str) -> List[dict]:
-    url = "https://nominatim.openstreetmap.org/search"
-    params = {"format": "json", "q": q, "limit": "5", "addressdetails": "0"}
-    headers = {"User-Agent": GEOCODE_UA}
-    async with aiohttp.ClientSession(headers=headers) as sess:
-        async with sess.get(url, params=params, timeout=15) as resp:
-            if resp.status != 200:
-                return []
-            data = await resp.json()
-            out = []
-            for it in data:
-                try:
-                    out.append({
-                        "display_name": it.get("display_name", ""),
-                        "lat": float(it["lat"]),
-                        "lon": float(it["lon"]),
-                    })
-                except Exception:
+# ===== Metrics =====
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count", "errors")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.errors = 0
+
+    def observe(self, seconds: float, error: bool = False):
+        i = 0
+        while i < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += seconds
+        self.count += 1
+        if error:
+            self.errors += 1
+
+    def quantile(self, q: float) -> float:
+        # linear interpolation inside the bucket holding the q-th observation, like histogram_quantile()
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            if seen + c >= rank and c:
+                if i == len(LATENCY_BUCKETS):
+                    return LATENCY_BUCKETS[-1]
+                lo = LATENCY_BUCKETS[i - 1] if i else 0.0
+                return lo + (LATENCY_BUCKETS[i] - lo) * (rank - seen) / c
+            seen += c
+        return LATENCY_BUCKETS[-1]
+
+class Metrics:
+    # In-process latency histograms per (kind, name) plus plain counters, rendered in the
+    # Prometheus text format. kind is one of handler, db, geocode, telegram_api, outbound.
+    def __init__(self):
+        self.hists: dict = {}  # (kind, name) -> Histogram
+        self.counters: Counter = Counter()  # (metric, ((label, value), ...)) -> n
+        self.started = time.time()
+
+    def observe(self, kind: str, name: str, seconds: float, error: bool = False):
+        h = self.hists.get((kind, name))
+        if h is None:
+            h = self.hists[(kind, name)] = Histogram()
+        h.observe(seconds, error)
+
+    def inc(self, metric: str, value: float = 1, **labels):
+        self.counters[(metric, tuple(sorted(labels.items())))] += value
+
+    @staticmethod
+    def _labels(pairs) -> str:
+        if not pairs:
+            return ""
+        esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+
+    def render(self) -> str:
+        out = []
+        label_key = {"telegram_api": "method"}
+        for kind in sorted({k for k, _ in self.hists}):
+            metric = f"broker_{kind}_seconds"
+            lk = label_key.get(kind, "name")
+            out.append(f"# TYPE {metric} histogram")
+            for (k, name), h in sorted(self.hists.items()):
+                if k != kind:
                     continue
-            return out
+                cum = 0
+                for bound, c in zip(LATENCY_BUCKETS + (float("inf"),), h.counts):
+                    cum += c
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    out.append(f"{metric}_bucket{self._labels([(lk, name), ('le', le)])} {cum}")
+                out.append(f"{metric}_sum{self._labels([(lk, name)])} {h.sum:.6f}")
+                out.append(f"{metric}_count{self._labels([(lk, name)])} {h.count}")
+            out.append(f"# TYPE broker_{kind}_errors_total counter")
+            for (k, name), h in sorted(self.hists.items()):
+                if k == kind:
+                    out.append(f"broker_{kind}_errors_total{self._labels([(lk, name)])} {h.errors}")
+        counters = dict(self.counters)
+        for c in REF_CACHES:
+            counters[("broker_cache_hits_total", (("cache", c.name),))] = c.hits
+            counters[("broker_cache_misses_total", (("cache", c.name),))] = c.misses
+        gs = GEOCACHE.stats
+        for tier in ("lru_hits", "db_hits"):
+            counters[("broker_geocode_cache_hits_total", (("tier", tier[:-5]),))] = gs[tier]
+        counters[("broker_geocode_cache_misses_total", ())] = gs["misses"]
+        counters[("broker_geocode_coalesced_total", ())] = gs["coalesced"]
+        for metric in sorted({m for m, _ in counters}):
+            out.append(f"# TYPE {metric} counter")
+            for (m, labels), v in sorted(counters.items()):
+                if m == metric:
+                    out.append(f"{metric}{self._labels(labels)} {v}")
+        out.append("# TYPE broker_uptime_seconds gauge")
+        out.append(f"broker_uptime_seconds {time.time() - self.started:.0f}")
+        return "\n".join(out) + "\n"
+
+    def summary(self, top: int = 8) -> str:
+        titles = {"handler": "Обработчики", "db": "БД", "geocode": "Геокодер", "telegram_api": "Bot API",
+                  "outbound": "Отправка с учётом лимитов"}
+        lines = []
+        for kind, title in titles.items():
+            rows = sorted(((h.sum, name, h) for (k, name), h in self.hists.items() if k == kind), reverse=True)
+            if not rows:
+                continue
+            lines.append(f"{title}:")
+            for total, name, h in rows[:top]:
+                lines.append(f"  {name}: {h.count} шт, p50 {h.quantile(0.5) * 1000:.1f} мс, "
+                             f"p95 {h.quantile(0.95) * 1000:.1f} мс, всего {total:.1f} с"
+                             + (f", ошибок {h.errors}" if h.errors else ""))
+        return "\n".join(lines) or "Метрик пока нет."
+
+METRICS = Metrics()
+
+def observe(kind: str, name: Optional[str] = None):
+    # decorator: time an async function into METRICS under (kind, name or function name) and,
+    # inside a traced update, record it as a span
+    def wrap(fn):
+        label = name or fn.__name__
+
+        @functools.wraps(fn)
+        async def timed(*args, **kwargs):
+            tr = CURRENT_TRACE.get()
+            sid = tr.open(kind, label) if tr is not None else None
+            token = _SPAN_PARENT.set(sid) if sid is not None else None
+            t0 = time.perf_counter()
+            error = True
+            try:
+                result = await fn(*args, **kwargs)
+                error = False
+                return result
+            finally:
+                dt = time.perf_counter() - t0
+                METRICS.observe(kind, label, dt, error)
+                if sid is not None:
+                    _SPAN_PARENT.reset(token)
+                    tr.close(sid, dt, error)
+        return timed
+    return wrap
+
+class InstrumentedRequest(HTTPXRequest):
+    # HTTPXRequest that times every Bot API call by method name and counts response codes
+    async def do_request(self, url: str, method: str, request_data=None, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        tr = CURRENT_TRACE.get()
+        sid = tr.open("telegram_api", api_method) if tr is not None else None
+        t0 = time.perf_counter()
+        code = None
+        try:
+            code, payload = await super().do_request(url, method, request_data, **kwargs)
+        finally:
+            dt = time.perf_counter() - t0
+            error = code is None or code >= 400
+            METRICS.observe("telegram_api", api_method, dt, error)
+            if sid is not None:
+                tr.close(sid, dt, error)
+        METRICS.inc("broker_telegram_api_responses_total", method=api_method, code=code)
+        return code, payload
+
+def instrument_handlers(app):
+    # wrap every handler callback (conversation steps included) with observe("handler")
+    def walk(handlers):
+        for h in handlers:
+            if isinstance(h, ConversationHandler):
+                walk(h.entry_points)
+                for state_handlers in h.states.values():
+                    walk(state_handlers)
+                walk(h.fallbacks)
+            elif hasattr(h, "callback") and not getattr(h.callback, "_observed", False):
+                h.callback = observe("handler", h.callback.__name__)(h.callback)
+                h.callback._observed = True
+    for group in app.handlers.values():
+        walk(group)
+
+async def start_metrics_server() -> Optional[web.AppRunner]:
+    if not METRICS_PORT:
+        return None
+
+    async def on_metrics(request: web.Request) -> web.Response:
+        return web.Response(text=METRICS.render(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Content-Type-Options": "nosniff"})
+
+    webapp = web.Application()
+    webapp.router.add_get("/metrics", on_metrics)
+    runner = web.AppRunner(webapp, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_LISTEN, METRICS_PORT).start()
+    logging.info("metrics on http://%s:%s/metrics", METRICS_LISTEN, METRICS_PORT)
+    return runner
+
+# ===== Tracing =====
+class Trace:
+    # Spans of one update: [kind, name, start offset s, duration s, parent index, error].
+    # The parent of a new span is whatever span is open in the current task (_SPAN_PARENT).
+    MAX_SPANS = 256
+    __slots__ = ("trace_id", "update_id", "user_id", "label", "t0", "wall", "queued", "spans", "dropped", "done")
+
+    def __init__(self, update: Update):
+        self.trace_id = os.urandom(8).hex()
+        self.update_id = update.update_id
+        self.user_id = update.effective_user.id if update.effective_user else None
+        self.label = _update_label(update)
+        self.t0 = time.perf_counter()
+        self.wall = time.time()
+        self.queued = 0.0
+        self.spans: list = []
+        self.dropped = 0
+        self.done = False
+
+    def open(self, kind: str, name: str) -> Optional[int]:
+        if self.done:
+            return None  # background work that outlived the update
+        if len(self.spans) >= self.MAX_SPANS:
+            self.dropped += 1
+            return None
+        self.spans.append([kind, name, time.perf_counter() - self.t0, 0.0, _SPAN_PARENT.get(), False])
+        return len(self.spans) - 1
+
+    def close(self, sid: int, seconds: float, error: bool):
+        sp = self.spans[sid]
+        sp[3] = seconds
+        sp[5] = error
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "trace_id": self.trace_id, "update_id": self.update_id, "user_id": self.user_id, "update": self.label,
+            "ts": datetime.utcfromtimestamp(self.wall).isoformat(timespec="milliseconds") + "Z",
+            "ms": round((time.perf_counter() - self.t0) * 1000, 3), "queued_ms": round(self.queued * 1000, 3),
+            "spans": [{"kind": k, "name": n, "start_ms": round(st * 1000, 3), "ms": round(d * 1000, 3),
+                       **({"parent": p} if p is not None else {}), **({"error": True} if e else {})}
+                      for k, n, st, d, p, e in self.spans],
+            **({"dropped_spans": self.dropped} if self.dropped else {}),
+        }, ensure_ascii=False)
+
+    def breakdown(self) -> str:
+        children: dict = {}
+        for i, sp in enumerate(self.spans):
+            children.setdefault(sp[4], []).append(i)
+        lines = []
+
+        def walk(parent, depth):
+            for i in children.get(parent, []):
+                k, n, st, d, _, e = self.spans[i]
+                lines.append(f"{'  ' * depth}{k} {n} {d * 1000:.1f} ms (+{st * 1000:.1f})" + (" ERROR" if e else ""))
+                walk(i, depth + 1)
+        walk(None, 1)
+        return "\n".join(lines)
+
+def _update_label(update: Update) -> str:
+    # what kind of update this was, without user-entered text
+    if update.callback_query:
+        return "callback " + (update.callback_query.data or "").split(":", 1)[0]
+    msg = update.effective_message
+    if msg is not None:
+        if msg.text and msg.text.startswith("/"):
+            return "command " + msg.text.split()[0].split("@")[0]
+        if msg.location:
+            return "location"
+        return "message"
+    return "update"
+
+CURRENT_TRACE: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+_SPAN_PARENT: ContextVar[Optional[int]] = ContextVar("span_parent", default=None)
+
+class Tracer:
+    # Writes finished traces as JSON lines through a QueueHandler, so the rotating file is
+    # written from the listener thread and never blocks the event loop.
+    def __init__(self, path: str, max_mb: float, backups: int, sample: float, slow_ms: float):
+        self.path = path
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.backups = backups
+        self.sample = sample
+        self.slow_ms = slow_ms
+        self.logger = logging.getLogger("broker.traces")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.listener: Optional[logging.handlers.QueueListener] = None
+        self.written = 0
+        self.slow = 0
+
+    def open(self):
+        if not self.path or self.listener is not None:
+            return
+        fh = logging.handlers.RotatingFileHandler(self.path, maxBytes=self.max_bytes, backupCount=self.backups,
+                                                  encoding="utf-8", delay=True)
+        fh.setFormatter(logging.Formatter("%(message)s"))
+        q: queue.SimpleQueue = queue.SimpleQueue()
+        self.logger.addHandler(logging.handlers.QueueHandler(q))
+        self.listener = logging.handlers.QueueListener(q, fh)
+        self.listener.start()
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+            for h in self.listener.handlers:
+                h.close()
+            self.logger.handlers.clear()
+            self.listener = None
+
+    def finish(self, tr: Trace):
+        tr.done = True
+        ms = (time.perf_counter() - tr.t0) * 1000
+        if ms >= self.slow_ms:
+            self.slow += 1
+            logging.warning("slow update %s (%s, user %s) %.0f ms, queued %.0f ms, trace %s:\n%s",
+                            tr.update_id, tr.label, tr.user_id, ms, tr.queued * 1000, tr.trace_id, tr.breakdown())
+        if self.listener is not None and (self.sample >= 1 or random.random() < self.sample):
+            self.written += 1
+            self.logger.info(tr.to_json())
+
+TRACER = Tracer(TRACE_FILE, TRACE_FILE_MB, TRACE_FILE_BACKUPS, TRACE_SAMPLE, SLOW_UPDATE_MS)
+
+# ===== Rate limiting & geocoding =====
+class TokenBucket:
+    # refills `rate` tokens per second up to `capacity`; acquire() waits its turn (FIFO)
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+# one HTTP session for the application lifetime (opened in _post_init, closed on shutdown)
+HTTP: Optional[aiohttp.ClientSession] = None
+
+def http_session() -> aiohttp.ClientSession:
+    global HTTP
+    if HTTP is None or HTTP.closed:
+        HTTP = aiohttp.ClientSession(
+            headers={"User-Agent": GEOCODE_UA},
+            timeout=aiohttp.ClientTimeout(total=15),
+            connector=aiohttp.TCPConnector(limit=20, ttl_dns_cache=300),
+        )
+    return HTTP
+
+async def http_close():
+    global HTTP
+    if HTTP is not None:
+        await HTTP.close()
+        HTTP = None
+
+# Nominatim usage policy: at most 1 request per second
+GEOCODE_LIMITER = TokenBucket(rate=float(os.getenv("GEOCODE_RPS", "1")))
+GEOCODE_INFLIGHT: dict = {}  # normalized query -> Task, so identical concurrent lookups share one call
+
+async def _geocode_fetch(q: str) -> Optional[List[dict]]:
+    # None means the geocoder failed (non-200), [] that it found nothing
+    params = {"format": "json", "q": q, "limit": "5", "addressdetails": "0"}
+    async with http_session().get(GEOCODE_URL, params=params) as resp:
+        if resp.status != 200:
+            return None
+        data = await resp.json()
+        out = []
+        for it in data:
+            try:
+                out.append({
+                    "display_name": it.get("display_name", ""),
+                    "lat": float(it["lat"]),
+                    "lon": float(it["lon"]),
+                })
+            except Exception:
+                continue
+        return out
+
+def geocode_key(q: str) -> str:
+    return re.sub(r"\s*,\s*", ", ", " ".join((q or "").casefold().split())).strip(" ,.")
+
+class GeocodeCache:
+    # in-process LRU in front of the geocode_cache table; both tiers honour the same TTL
+    def __init__(self, lru_size: int, ttl_s: float, max_rows: int):
+        self.lru: OrderedDict = OrderedDict()  # key -> (results, created_at)
+        self.lru_size = lru_size
+        self.ttl_s = ttl_s
+        self.max_rows = max_rows
+        self.stats = {"lru_hits": 0, "db_hits": 0, "misses": 0, "coalesced": 0, "upstream_calls": 0, "upstream_ms": 0.0}
+        self._puts = 0
+
+    def _remember(self, key: str, results: List[dict], created_at: datetime):
+        self.lru[key] = (results, created_at)
+        self.lru.move_to_end(key)
+        while len(self.lru) > self.lru_size:
+            self.lru.popitem(last=False)
+
+    async def get(self, key: str) -> Optional[List[dict]]:
+        now = datetime.utcnow()
+        hit = self.lru.get(key)
+        if hit is not None:
+            if (now - hit[1]).total_seconds() < self.ttl_s:
+                self.lru.move_to_end(key)
+                self.stats["lru_hits"] += 1
+                return hit[0]
+            del self.lru[key]
+        cutoff = (now - timedelta(seconds=self.ttl_s)).isoformat()
+        row = await DB.fetchone("SELECT results, created_at FROM geocode_cache WHERE query=? AND created_at>=?", (key, cutoff))
+        if row:
+            results = json.loads(row[0])
+            self._remember(key, results, datetime.fromisoformat(row[1]))
+            self.stats["db_hits"] += 1
+            return results
+        # geocode_address() counts the miss, or a coalesced lookup if one is already in flight
+        return None
+
+    async def put(self, key: str, results: List[dict]):
+        now = datetime.utcnow()
+        self._remember(key, results, now)
+        async with DB.transaction() as db:
+            await db.execute("INSERT OR REPLACE INTO geocode_cache(query, results, created_at) VALUES(?,?,?)",
+                             (key, json.dumps(results, ensure_ascii=False), now.isoformat()))
+            self._puts += 1
+            if self._puts % 50 == 1:
+                await db.execute("DELETE FROM geocode_cache WHERE created_at<?",
+                                 ((now - timedelta(seconds=self.ttl_s)).isoformat(),))
+                await db.execute("DELETE FROM geocode_cache WHERE query IN "
+                                 "(SELECT query FROM geocode_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                                 (self.max_rows,))
+
+    def summary(self) -> str:
+        s = self.stats
+        hits = s["lru_hits"] + s["db_hits"]
+        total = hits + s["coalesced"] + s["misses"]
+        avg_ms = s["upstream_ms"] / s["upstream_calls"] if s["upstream_calls"] else 0.0
+        saved = hits + s["coalesced"]
+        return (
+            f"geocode: запросов {total}, попаданий {hits} (LRU {s['lru_hits']}, БД {s['db_hits']}), "
+            f"склеено {s['coalesced']}, промахов {s['misses']}, hit rate {hits / total if total else 0:.0%}, "
+            f"без вызова Nominatim {saved / total if total else 0:.0%}\n"
+            f"Nominatim: вызовов {s['upstream_calls']}, среднее {avg_ms:.0f} мс, "
+            f"сэкономлено ~{saved * avg_ms / 1000:.1f} с; LRU {len(self.lru)}/{self.lru_size}"
+        )
+
+GEOCACHE = GeocodeCache(
+    lru_size=int(os.getenv("GEOCODE_LRU_SIZE", "1024")),
+    ttl_s=float(os.getenv("GEOCODE_CACHE_TTL_DAYS", "30")) * 86400,
+    max_rows=int(os.getenv("GEOCODE_CACHE_MAX_ROWS", "50000")),
+)
+
+async def _geocode_resolve(key: str, q: str) -> List[dict]:
+    await GEOCODE_LIMITER.acquire()
+    t0 = time.perf_counter()
+    results = await _geocode_fetch(q)
+    GEOCACHE.stats["upstream_calls"] += 1
+    GEOCACHE.stats["upstream_ms"] += (time.perf_counter() - t0) * 1000
+    if not results:
+        return []
+    await GEOCACHE.put(key, results)
+    return results
+
+@observe("geocode")
+async def geocode_address(q: str) -> List[dict]:
+    key = geocode_key(q)
+    if not key:
+        return []
+    cached = await GEOCACHE.get(key)
+    if cached is not None:
+        return [dict(r) for r in cached]
+    task = GEOCODE_INFLIGHT.get(key)
+    if task is None:
+        GEOCACHE.stats["misses"] += 1
+        task = asyncio.ensure_future(_geocode_resolve(key, q))
+        GEOCODE_INFLIGHT[key] = task
+        task.add_done_callback(lambda _: GEOCODE_INFLIGHT.pop(key, None))
+    else:
+        GEOCACHE.stats["coalesced"] += 1
+    # shield: one waiter being cancelled must not cancel the lookup for the others
+    results = await asyncio.shield(task)
+    return [dict(r) for r in results]
 
 # ===== DB Layer (SQLite async) =====
 DB_PATH = "broker.db"
+DB_READERS = int(os.getenv("DB_READERS", "3"))
+DB_STMT_CACHE = 256
 CREATE_SQL = """
 PRAGMA journal_mode=WAL;
 
@@ -107,6 +668,48 @@ CREATE TABLE IF NOT EXISTS executors(
   is_active INTEGER DEFAULT 1,
   created_at TEXT
 );
+CREATE TABLE IF NOT EXISTS executor_categories(
+  executor_id INTEGER NOT NULL,
+  category TEXT NOT NULL,
+  PRIMARY KEY(category, executor_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ix_executor_categories_exec ON executor_categories(executor_id, category);
+CREATE TABLE IF NOT EXISTS geocode_cache(
+  query TEXT PRIMARY KEY,
+  results TEXT NOT NULL,
+  created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_geocode_cache_created ON geocode_cache(created_at);
+CREATE TABLE IF NOT EXISTS outbox(
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  chat_id INTEGER NOT NULL,
+  kind TEXT NOT NULL,
+  text TEXT NOT NULL,
+  reply_markup TEXT,
+  ref_id INTEGER,
+  status TEXT NOT NULL DEFAULT 'pending' CHECK(status IN ('pending','sent','failed','blocked')),
+  attempts INTEGER NOT NULL DEFAULT 0,
+  next_at REAL NOT NULL,
+  last_error TEXT,
+  created_at TEXT NOT NULL,
+  sent_at TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_outbox_due ON outbox(next_at, id) WHERE status='pending';
+CREATE INDEX IF NOT EXISTS ix_outbox_created ON outbox(created_at);
+CREATE INDEX IF NOT EXISTS ix_outbox_chat ON outbox(chat_id, kind) WHERE status='pending';
+CREATE INDEX IF NOT EXISTS ix_outbox_ref ON outbox(ref_id, kind) WHERE ref_id IS NOT NULL;
+CREATE TABLE IF NOT EXISTS bot_user_data(
+  user_id INTEGER PRIMARY KEY,
+  data TEXT NOT NULL,
+  updated_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS bot_conversations(
+  name TEXT NOT NULL,
+  key TEXT NOT NULL,
+  state TEXT NOT NULL,
+  updated_at TEXT NOT NULL,
+  PRIMARY KEY(name, key)
+) WITHOUT ROWID;
 CREATE TABLE IF NOT EXISTS requests(
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   client_user_id INTEGER,
@@ -139,8 +742,166 @@ CREATE TABLE IF NOT EXISTS deals(
   created_at TEXT
 );
 """
+# secondary indexes for the hot queries; applied after the column migrations in db_init()
+# (check with `python -m benchmarks.check_plans`)
+INDEX_SQL = """
+CREATE INDEX IF NOT EXISTS ix_offers_request ON offers(request_id, id);
+CREATE INDEX IF NOT EXISTS ix_requests_client ON requests(client_user_id, id);
+CREATE UNIQUE INDEX IF NOT EXISTS ux_deals_offer ON deals(offer_id);
+CREATE INDEX IF NOT EXISTS ix_executors_pending_username ON executors(pending_username) WHERE pending_username IS NOT NULL;
+CREATE INDEX IF NOT EXISTS ix_executors_direct_tg_id ON executors(direct_tg_id) WHERE direct_tg_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS ix_executors_city ON executors(city);
+"""
+# R*Tree over executor points, kept in sync with executors.lat/lon by triggers
+GEO_SQL = """
+CREATE VIRTUAL TABLE IF NOT EXISTS executors_geo USING rtree(id, min_lat, max_lat, min_lon, max_lon);
+CREATE TRIGGER IF NOT EXISTS executors_geo_ins AFTER INSERT ON executors
+WHEN NEW.lat IS NOT NULL AND NEW.lon IS NOT NULL BEGIN
+  INSERT OR REPLACE INTO executors_geo VALUES(NEW.id, NEW.lat, NEW.lat, NEW.lon, NEW.lon);
+END;
+CREATE TRIGGER IF NOT EXISTS executors_geo_upd AFTER UPDATE OF lat, lon ON executors BEGIN
+  DELETE FROM executors_geo WHERE id=OLD.id;
+  INSERT INTO executors_geo SELECT NEW.id, NEW.lat, NEW.lat, NEW.lon, NEW.lon WHERE NEW.lat IS NOT NULL AND NEW.lon IS NOT NULL;
+END;
+CREATE TRIGGER IF NOT EXISTS executors_geo_del AFTER DELETE ON executors BEGIN
+  DELETE FROM executors_geo WHERE id=OLD.id;
+END;
+INSERT OR REPLACE INTO executors_geo
+  SELECT id, lat, lat, lon, lon FROM executors
+  WHERE lat IS NOT NULL AND lon IS NOT NULL AND id NOT IN (SELECT id FROM executors_geo);
+"""
+GEO_INDEX = False
+
+class DBGateway:
+    # One serialized writer plus a small pool of read-only WAL readers. Connections live for
+    # the whole process, so sqlite3's per-connection statement cache is reused between calls
+    # and a helper call costs a hop to the connection thread instead of connect/teardown.
+    def __init__(self, path: str, readers: int = 3):
+        self.path = path
+        self.n_readers = max(1, readers)
+        self.writer: Optional[aiosqlite.Connection] = None
+        self._readers: List[aiosqlite.Connection] = []
+        self._idle: Optional[asyncio.Queue] = None
+        self._wlock = asyncio.Lock()
+
+    async def open(self):
+        self.writer = await aiosqlite.connect(self.path, cached_statements=DB_STMT_CACHE)
+        await self.writer.execute("PRAGMA journal_mode=WAL")
+        await self.writer.execute("PRAGMA synchronous=NORMAL")
+        await self.writer.execute("PRAGMA busy_timeout=5000")
+        self._idle = asyncio.Queue()
+        ro_uri = Path(self.path).resolve().as_uri() + "?mode=ro"
+        for _ in range(self.n_readers):
+            rd = await aiosqlite.connect(ro_uri, uri=True, cached_statements=DB_STMT_CACHE)
+            await rd.execute("PRAGMA busy_timeout=5000")
+            self._readers.append(rd)
+            self._idle.put_nowait(rd)
+
+    async def close(self):
+        for rd in self._readers:
+            await rd.close()
+        self._readers.clear()
+        if self.writer is not None:
+            await self.writer.close()
+            self.writer = None
+
+    @asynccontextmanager
+    async def reader(self):
+        rd = await self._idle.get()
+        try:
+            yield rd
+        finally:
+            self._idle.put_nowait(rd)
+
+    @asynccontextmanager
+    async def transaction(self):
+        # all writes go through the single writer; the lock keeps transactions from interleaving
+        async with self._wlock:
+            try:
+                yield self.writer
+            except BaseException:
+                await self.writer.rollback()
+                raise
+            await self.writer.commit()
+
+    async def fetchall(self, sql: str, params=()) -> List[Tuple]:
+        async with self.reader() as rd:
+            return list(await rd.execute_fetchall(sql, params))
+
+    async def fetchone(self, sql: str, params=()) -> Optional[Tuple]:
+        rows = await self.fetchall(sql, params)
+        return rows[0] if rows else None
+
+    async def execute(self, sql: str, params=()) -> int:
+        async with self.transaction() as db:
+            cur = await db.execute(sql, params)
+            return cur.lastrowid
+
+DB: Optional[DBGateway] = None
+
+class RefCache:
+    # Small in-process cache for rarely changing reference data. No TTL: every writer of the
+    # underlying rows must set() or invalidate() explicitly.
+    _MISSING = object()
+
+    def __init__(self, name: str, maxsize: int = 10000):
+        self.name = name
+        self.maxsize = maxsize
+        self.data: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0  # bumped by invalidate()
+
+    def get(self, key, default=None):
+        value = self.data.get(key, self._MISSING)
+        if value is self._MISSING:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def invalidate(self, key=_MISSING):
+        self.generation += 1
+        if key is self._MISSING:
+            self.data.clear()
+        else:
+            self.data.pop(key, None)
+
+    async def get_or_load(self, key, loader):
+        value = self.get(key, self._MISSING)
+        if value is self._MISSING:
+            generation = self.generation
+            value = await loader()
+            # a write that invalidated meanwhile may have landed after the loader's read
+            if value is not None and generation == self.generation:
+                self.set(key, value)
+        return value
+
+    def summary(self) -> str:
+        total = self.hits + self.misses
+        return (f"{self.name}: {len(self.data)}/{self.maxsize}, hits {self.hits}, misses {self.misses}, "
+                f"hit rate {self.hits / total if total else 0:.0%}")
+
+SETTINGS_CACHE = RefCache("settings", maxsize=16)
+ROLE_CACHE = RefCache("roles")          # tg_id -> users.role
+USER_IDS = RefCache("user_ids", maxsize=int(os.getenv("USER_CACHE_SIZE", "50000")))  # tg_id -> users.id
+EXECUTORS = RefCache("executors", maxsize=int(os.getenv("EXEC_CACHE_SIZE", "10000")))  # id -> get_executor() row
+REF_CACHES = (SETTINGS_CACHE, ROLE_CACHE, USER_IDS, EXECUTORS)
+
 async def db_init():
-    async with aiosqlite.connect(DB_PATH) as db:
+    global DB, GEO_INDEX
+    if DB is None:
+        DB = DBGateway(DB_PATH, readers=DB_READERS)
+        await DB.open()
+    db = DB.writer
+    async with DB._wlock:
         await db.executescript(CREATE_SQL)
         # migrations
         cur = await db.execute("PRAGMA table_info(executors)")
@@ -153,191 +914,1059 @@ async def db_init():
             await db.execute("ALTER TABLE requests ADD COLUMN address_text TEXT")
         if "mode" not in cols:
             await db.execute("ALTER TABLE requests ADD COLUMN mode TEXT")
-        await db.commit()
-
-async def get_or_create_user(tg, role: Optional[str]=None) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT id, role FROM users WHERE tg_id=?", (tg.id,))
-        row = await cur.fetchone()
-        if row:
-            uid, old_role = row
-            if role and old_role != role and not is_admin(tg.id):
-                await db.execute("UPDATE users SET role=? WHERE id=?", (role, uid))
-                await db.commit()
-            return uid
-        await db.execute(
-            "INSERT INTO users(tg_id, username, first_name, last_name, role) VALUES(?,?,?,?,?)",
-            (tg.id, tg.username, getattr(tg, "first_name", None), getattr(tg, "last_name", None), 'admin' if is_admin(tg.id) else role)
+        cur = await db.execute("PRAGMA table_info(outbox)")
+        if "ref_id" not in [r[1] for r in await cur.fetchall()]:
+            await db.execute("ALTER TABLE outbox ADD COLUMN ref_id INTEGER")
+        # executors.categories (CSV) -> executor_categories for rows not migrated yet
+        cur = await db.execute(
+            "SELECT id, categories FROM executors "
+            "WHERE categories IS NOT NULL AND id NOT IN (SELECT executor_id FROM executor_categories)"
+        )
+        await db.executemany(
+            "INSERT OR IGNORE INTO executor_categories(executor_id, category) VALUES(?,?)",
+            [(eid, c.strip()) for eid, cats in await cur.fetchall() for c in cats.split(",") if c.strip()]
         )
         await db.commit()
-        if tg.username:
-            await db.execute("UPDATE executors SET user_id=(SELECT id FROM users WHERE tg_id=?), pending_username=NULL WHERE pending_username=?", (tg.id, tg.username))
+        cur = await db.execute("SELECT 1 FROM sqlite_master WHERE type='index' AND name='ux_deals_offer'")
+        if not await cur.fetchone():
+            # double taps on "accept" used to create duplicate deals; keep the first one per offer
+            await db.execute("DELETE FROM deals WHERE id NOT IN (SELECT MIN(id) FROM deals GROUP BY offer_id)")
             await db.commit()
-        await db.execute("UPDATE executors SET user_id=(SELECT id FROM users WHERE tg_id=? ) WHERE direct_tg_id=?", (tg.id, tg.id))
-        await db.commit()
-        cur = await db.execute("SELECT id FROM users WHERE tg_id=?", (tg.id,))
-        uid = (await cur.fetchone())[0]
-        return uid
+        await db.executescript(INDEX_SQL)
+        try:
+            await db.executescript(GEO_SQL)
+            GEO_INDEX = True
+        except sqlite3.OperationalError as e:
+            logging.warning("R*Tree unavailable, find_candidates will scan executors: %s", e)
+    for cache in REF_CACHES:
+        cache.invalidate()
+    await MATCHER.load()
+
+async def db_close():
+    global DB
+    if DB is not None:
+        await DB.close()
+        DB = None
+
+# Registration is one upsert plus the executor linking, in a single transaction. The role is only
+# overwritten when one is given and the user is not an admin; the username is kept fresh.
+UPSERT_USER_SQL = (
+    "INSERT INTO users(tg_id, username, first_name, last_name, role) VALUES(:tg_id, :username, :first_name, :last_name, :new_role) "
+    "ON CONFLICT(tg_id) DO UPDATE SET username=excluded.username, "
+    "role=CASE WHEN :role IS NOT NULL AND NOT :is_admin THEN :role ELSE users.role END "
+    "RETURNING id, role"
+)
 
+@observe("db")
+async def get_or_create_user(tg, role: Optional[str]=None) -> int:
+    uid = USER_IDS.get(tg.id)
+    if uid is not None and (not role or is_admin(tg.id) or ROLE_CACHE.get(tg.id) == role):
+        return uid
+    admin = is_admin(tg.id)
+    async with DB.transaction() as db:
+        (uid, new_role), = await db.execute_fetchall(UPSERT_USER_SQL, {
+            "tg_id": tg.id, "username": tg.username,
+            "first_name": getattr(tg, "first_name", None), "last_name": getattr(tg, "last_name", None),
+            "new_role": 'admin' if admin else role, "role": role, "is_admin": admin,
+        })
+        # link executors waiting for this user; only rows that actually change are returned
+        linked = []
+        if tg.username:
+            linked += await db.execute_fetchall(
+                "UPDATE executors SET user_id=?, pending_username=NULL WHERE pending_username=? "
+                "RETURNING id, user_id, pending_username", (uid, tg.username))
+        linked += await db.execute_fetchall(
+            "UPDATE executors SET user_id=? WHERE direct_tg_id=? AND user_id IS NOT ? "
+            "RETURNING id, user_id, pending_username", (uid, tg.id, uid))
+    USER_IDS.set(tg.id, uid)
+    ROLE_CACHE.set(tg.id, new_role)
+    for exec_id, user_id, pending_username in linked:
+        EXECUTORS.invalidate(exec_id)
+        MATCHER.link_user(exec_id, user_id, pending_username, tg.id)
+    return uid
+
+@observe("db")
 async def set_role(tg_id: int, role: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE users SET role=? WHERE tg_id=?", (role, tg_id))
-        await db.commit()
+    await DB.execute("UPDATE users SET role=? WHERE tg_id=?", (role, tg_id))
+    ROLE_CACHE.set(tg_id, role)
 
+@observe("db")
 async def settings_get():
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT prefer_owner_first FROM settings WHERE id=1")
-        r = await cur.fetchone()
+    async def load():
+        r = await DB.fetchone("SELECT prefer_owner_first FROM settings WHERE id=1")
         return bool(r[0]) if r else True
+    return await SETTINGS_CACHE.get_or_load("prefer_owner_first", load)
 
+@observe("db")
 async def settings_set_prefer_owner(v: bool):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE settings SET prefer_owner_first=? WHERE id=1", (1 if v else 0,))
-        await db.commit()
+    await DB.execute("UPDATE settings SET prefer_owner_first=? WHERE id=1", (1 if v else 0,))
+    SETTINGS_CACHE.set("prefer_owner_first", bool(v))
 
+@observe("db")
 async def admin_add_executor(pending_username: Optional[str], city: str, radius_km: float,
                              categories: List[str], is_owner: bool, direct_tg_id: Optional[int]=None) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
+    async with DB.transaction() as db:
+        cur = await db.execute(
             "INSERT INTO executors(user_id, pending_username, direct_tg_id, categories, city, lat, lon, radius_km, is_owner, is_active, created_at) "
             "VALUES(NULL,?,?,?,?,NULL,NULL,?, ?, 1, ?)",
             (pending_username, direct_tg_id, ",".join(categories), city, radius_km, 1 if is_owner else 0, datetime.utcnow().isoformat())
         )
-        await db.commit()
-        cur = await db.execute("SELECT last_insert_rowid()")
-        return (await cur.fetchone())[0]
-
-async def admin_list_executors() -> List[Tuple]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT id, user_id, pending_username, direct_tg_id, city, radius_km, categories, is_owner, is_active FROM executors ORDER BY id DESC"
+        exec_id = cur.lastrowid
+        await db.executemany(
+            "INSERT OR IGNORE INTO executor_categories(executor_id, category) VALUES(?,?)",
+            [(exec_id, c) for c in categories]
         )
-        return await cur.fetchall()
-
+    EXECUTORS.invalidate(exec_id)
+    MATCHER.upsert(ExecRec(exec_id, None, pending_username, direct_tg_id, city, None, None,
+                           radius_km, 1 if is_owner else 0, 1, direct_tg_id, dict.fromkeys(categories)))
+    return exec_id
+
+def exec_filter_sql(f: dict) -> Tuple[str, tuple]:
+    # f: city, cat, owner (bool), active (bool); absent keys do not filter
+    conds, params = ["1=1"], []
+    if f.get("city"):
+        conds.append("executors.city=?"); params.append(f["city"])
+    if f.get("cat"):
+        conds.append("executors.id IN (SELECT executor_id FROM executor_categories WHERE category=?)"); params.append(f["cat"])
+    if f.get("owner") is not None:
+        conds.append("executors.is_owner=?"); params.append(1 if f["owner"] else 0)
+    if f.get("active") is not None:
+        conds.append("executors.is_active=?"); params.append(1 if f["active"] else 0)
+    return " AND ".join(conds), tuple(params)
+
+@observe("db")
+async def admin_executors_page(f: dict, cursor: int = 0, newer: bool = False, limit: int = 15):
+    # (rows, has_older, has_newer) for one page of the filtered listing, newest first; no total,
+    # since counting would walk the whole filtered set on every click
+    where, params = exec_filter_sql(f)
+    async with DB.reader() as db:
+        return await keyset_page(
+            db, "SELECT id, user_id, pending_username, direct_tg_id, city, radius_km, categories, is_owner, is_active "
+                "FROM executors", where, params, cursor, newer, limit)
+
+EXPORT_COLUMNS = ("id", "user_id", "username", "pending_username", "direct_tg_id", "city", "lat", "lon",
+                  "radius_km", "categories", "is_owner", "is_active", "created_at")
+
+@observe("db")
+async def admin_export_executors(f: dict, out) -> int:
+    # writes the filtered executors as CSV to the text file `out`, streaming from the cursor in
+    # chunks so the table is never held in memory; returns the row count
+    where, params = exec_filter_sql(f)
+    w = csv.writer(out)
+    w.writerow(EXPORT_COLUMNS)
+    n = 0
+    async with DB.reader() as db:
+        async with db.execute(
+                "SELECT executors.id, executors.user_id, u.username, executors.pending_username, executors.direct_tg_id, "
+                "executors.city, executors.lat, executors.lon, executors.radius_km, executors.categories, "
+                "executors.is_owner, executors.is_active, executors.created_at "
+                f"FROM executors LEFT JOIN users u ON u.id=executors.user_id WHERE {where} ORDER BY executors.id",
+                params) as cur:
+            while True:
+                rows = await cur.fetchmany(500)
+                if not rows:
+                    break
+                w.writerows(rows)
+                n += len(rows)
+    return n
+
+@observe("db")
 async def set_executor_location(exec_id: int, lat: float, lon: float):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE executors SET lat=?, lon=? WHERE id=?", (lat, lon, exec_id))
-        await db.commit()
+    await DB.execute("UPDATE executors SET lat=?, lon=? WHERE id=?", (lat, lon, exec_id))
+    EXECUTORS.invalidate(exec_id)
+    MATCHER.set_location(exec_id, lat, lon)
 
+@observe("db")
 async def set_executor_active(exec_id: int, active: bool):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE executors SET is_active=? WHERE id=?", (1 if active else 0, exec_id))
-        await db.commit()
+    await DB.execute("UPDATE executors SET is_active=? WHERE id=?", (1 if active else 0, exec_id))
+    EXECUTORS.invalidate(exec_id)
+    MATCHER.set_active(exec_id, active)
 
+@observe("db")
 async def new_request(client_user_id: int, category: str, description: str,
                       address_text: str, city: str, lat: float, lon: float, radius_km: float, mode: str) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT INTO requests(client_user_id, category, description, address_text, city, lat, lon, client_radius_km, mode, status, created_at) "
-            "VALUES(?,?,?,?,?,?,?,?,?,'published',?)",
-            (client_user_id, category, description, address_text, city, lat, lon, radius_km, mode, datetime.utcnow().isoformat())
-        )
-        await db.commit()
-        cur = await db.execute("SELECT last_insert_rowid()")
-        return (await cur.fetchone())[0]
+    return await DB.execute(
+        "INSERT INTO requests(client_user_id, category, description, address_text, city, lat, lon, client_radius_km, mode, status, created_at) "
+        "VALUES(?,?,?,?,?,?,?,?,?,'published',?)",
+        (client_user_id, category, description, address_text, city, lat, lon, radius_km, mode, datetime.utcnow().isoformat())
+    )
 
+@observe("db")
 async def get_request(request_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT id, client_user_id, category, description, address_text, city, lat, lon, client_radius_km, mode, status, created_at FROM requests WHERE id=?", (request_id,))
-        return await cur.fetchone()
+    return await DB.fetchone("SELECT id, client_user_id, category, description, address_text, city, lat, lon, client_radius_km, mode, status, created_at FROM requests WHERE id=?", (request_id,))
 
+@observe("db")
 async def get_offers_by_request(req_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT id, executor_id, rate_type, rate_value, comment, status, created_at FROM offers WHERE request_id=? ORDER BY id DESC",
-            (req_id,)
-        )
-        return await cur.fetchall()
+    return await DB.fetchall(
+        "SELECT id, executor_id, rate_type, rate_value, comment, status, created_at FROM offers WHERE request_id=? ORDER BY id DESC",
+        (req_id,)
+    )
 
+MAX_ROWID = (1 << 63) - 1
+
+async def keyset_page(db, select: str, where: str, params: tuple, cursor: int, newer: bool, limit: int):
+    # One page of rows ordered by id DESC, walked by id instead of OFFSET so a deep page costs
+    # the same as the first: rows older than `cursor` (0 = the newest page) or, with newer=True,
+    # the page right above it. One extra row tells whether there is more past the edge.
+    # Returns (rows, has_older, has_newer).
+    if newer:
+        rows = await db.execute_fetchall(f"{select} WHERE {where} AND id>? ORDER BY id LIMIT ?",
+                                         (*params, cursor, limit + 1))
+        if len(rows) == limit + 1:
+            return rows[:limit][::-1], True, True
+        # the newest page may be short after deletions; show it in full
+        cursor = 0
+    # the newest page is bounded by the largest rowid, so it too is a rowid range search
+    rows = await db.execute_fetchall(f"{select} WHERE {where} AND id<? ORDER BY id DESC LIMIT ?",
+                                     (*params, cursor or MAX_ROWID, limit + 1))
+    return rows[:limit], len(rows) > limit, bool(cursor)
+
+# executor rows carry the resolved chat_id (linked user's tg_id, else direct_tg_id) as their last column
+EXEC_CHAT_ID_SQL = "COALESCE(u.tg_id, e.direct_tg_id)"
+
+@observe("db")
 async def get_executor(exec_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT id, user_id, pending_username, direct_tg_id, categories, city, lat, lon, radius_km, is_owner, is_active FROM executors WHERE id=?", (exec_id,))
-        return await cur.fetchone()
-
-async def find_candidates(req_id: int) -> List[Tuple]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT category, lat, lon, client_radius_km FROM requests WHERE id=?", (req_id,))
-        r = await cur.fetchone()
-        if not r: return []
-        cat, rlat, rlon, rr = r
-        cur = await db.execute(
-            "SELECT id, user_id, pending_username, direct_tg_id, categories, city, lat, lon, radius_km, is_owner "
-            "FROM executors WHERE is_active=1"
+    # cached; every writer of an executor row (or of its link to a user) invalidates it
+    async def load():
+        return await DB.fetchone(
+            "SELECT e.id, e.user_id, e.pending_username, e.direct_tg_id, e.categories, e.city, e.lat, e.lon, e.radius_km, e.is_owner, e.is_active, "
+            f"{EXEC_CHAT_ID_SQL} FROM executors e LEFT JOIN users u ON u.id=e.user_id WHERE e.id=?", (exec_id,))
+    return await EXECUTORS.get_or_load(exec_id, load)
+
+@observe("db")
+async def chat_ids_by_user_ids(user_ids) -> dict:
+    # batch user_id -> tg_id for multi-recipient sends
+    ids = list({u for u in user_ids if u})
+    out = {}
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        rows = await DB.fetchall(f"SELECT id, tg_id FROM users WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+        out.update(rows)
+    return out
+
+@observe("db")
+async def chat_ids_by_executor_ids(exec_ids) -> dict:
+    # batch executor_id -> resolved chat_id; executors with no reachable chat are left out
+    ids = list(set(exec_ids))
+    out = {}
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        rows = await DB.fetchall(
+            f"SELECT e.id, {EXEC_CHAT_ID_SQL} FROM executors e LEFT JOIN users u ON u.id=e.user_id "
+            f"WHERE e.id IN ({','.join('?' * len(chunk))})", chunk)
+        out.update((eid, chat_id) for eid, chat_id in rows if chat_id)
+    return out
+
+# ===== In-memory executor matching =====
+# SQLite stays the source of truth; this is a resident copy of the executor pool bucketed by
+# category and a CELL_DEG grid cell, loaded in db_init() and patched by the executor writers.
+CELL_DEG = 0.5
+
+def _cell(lat: float, lon: float) -> Tuple[int, int]:
+    return int(math.floor(lat / CELL_DEG)), int(math.floor(lon / CELL_DEG))
+
+class ExecRec:
+    __slots__ = ("id", "user_id", "pending_username", "direct_tg_id", "city", "lat", "lon",
+                 "radius_km", "is_owner", "is_active", "chat_id", "categories")
+
+    def __init__(self, id, user_id, pending_username, direct_tg_id, city, lat, lon,
+                 radius_km, is_owner, is_active, chat_id=None, categories=()):
+        self.id = id
+        self.user_id = user_id
+        self.pending_username = pending_username
+        self.direct_tg_id = direct_tg_id
+        self.city = city
+        self.lat = lat
+        self.lon = lon
+        self.radius_km = radius_km
+        self.is_owner = is_owner
+        self.is_active = is_active
+        self.chat_id = chat_id
+        self.categories = tuple(categories)
+
+    def key(self) -> Tuple:
+        return (self.user_id, self.pending_username, self.direct_tg_id, self.city, self.lat, self.lon,
+                self.radius_km, self.is_owner, self.is_active, self.chat_id, tuple(sorted(self.categories)))
+
+class ExecutorIndex:
+    def __init__(self):
+        self.loaded = False
+        self.recs: dict = {}
+        self.buckets: dict = {}  # category -> {cell: set(exec_id)}
+
+    async def _read_all(self) -> dict:
+        recs = {}
+        async with DB.reader() as db:
+            for row in await db.execute_fetchall(
+                "SELECT e.id, e.user_id, e.pending_username, e.direct_tg_id, e.city, e.lat, e.lon, e.radius_km, e.is_owner, e.is_active, "
+                f"{EXEC_CHAT_ID_SQL} FROM executors e LEFT JOIN users u ON u.id=e.user_id"
+            ):
+                recs[row[0]] = ExecRec(*row)
+            cats: dict = {}
+            for eid, cat in await db.execute_fetchall("SELECT executor_id, category FROM executor_categories"):
+                cats.setdefault(eid, []).append(cat)
+        for eid, rec in recs.items():
+            rec.categories = tuple(cats.get(eid, ()))
+        return recs
+
+    async def load(self):
+        self._replace(await self._read_all())
+
+    async def check(self, repair: bool = True) -> int:
+        # compare against SQLite; returns the number of executors that differ, rebuilding if asked
+        fresh = await self._read_all()
+        diff = sum(1 for eid in set(fresh) | set(self.recs)
+                   if eid not in fresh or eid not in self.recs or fresh[eid].key() != self.recs[eid].key())
+        if diff and repair:
+            self._replace(fresh)
+        return diff
+
+    def _replace(self, recs: dict):
+        self.recs = {}
+        self.buckets = {}
+        for rec in recs.values():
+            self.upsert(rec)
+        self.loaded = True
+
+    def _place(self, rec: ExecRec, add: bool):
+        if rec.lat is None or rec.lon is None:
+            return
+        cell = _cell(rec.lat, rec.lon)
+        for cat in rec.categories:
+            cells = self.buckets.setdefault(cat, {})
+            if add:
+                cells.setdefault(cell, set()).add(rec.id)
+            else:
+                ids = cells.get(cell)
+                if ids:
+                    ids.discard(rec.id)
+                    if not ids:
+                        del cells[cell]
+
+    def upsert(self, rec: ExecRec):
+        old = self.recs.get(rec.id)
+        if old is not None:
+            self._place(old, add=False)
+        self.recs[rec.id] = rec
+        self._place(rec, add=True)
+
+    def set_location(self, exec_id: int, lat: float, lon: float):
+        rec = self.recs.get(exec_id)
+        if rec is None:
+            return
+        self._place(rec, add=False)
+        rec.lat, rec.lon = lat, lon
+        self._place(rec, add=True)
+
+    def set_active(self, exec_id: int, active: bool):
+        rec = self.recs.get(exec_id)
+        if rec is not None:
+            rec.is_active = 1 if active else 0
+
+    def link_user(self, exec_id: int, user_id: int, pending_username: Optional[str], chat_id: int):
+        rec = self.recs.get(exec_id)
+        if rec is not None:
+            rec.user_id, rec.pending_username, rec.chat_id = user_id, pending_username, chat_id
+
+    def match(self, cat: str, lat: float, lon: float, max_km: float) -> List[Tuple[ExecRec, float]]:
+        # active executors of the category within max_km of the point and within their own radius;
+        # returns (rec, dist) pairs in no particular order
+        cells = self.buckets.get(cat)
+        if not cells:
+            return []
+        min_lat, max_lat, min_lon, max_lon = bbox_km(lat, lon, max_km)
+        (i0, j0), (i1, j1) = _cell(min_lat, min_lon), _cell(max_lat, max_lon)
+        if (i1 - i0 + 1) * (j1 - j0 + 1) >= len(cells):
+            groups = [ids for (i, j), ids in cells.items() if i0 <= i <= i1 and j0 <= j <= j1]
+        else:
+            groups = [cells[c] for c in ((i, j) for i in range(i0, i1 + 1) for j in range(j0, j1 + 1)) if c in cells]
+        recs = [self.recs[eid] for ids in groups for eid in ids]
+        recs = [r for r in recs if r.is_active]
+        dists, mask = haversine_batch(lat, lon, [r.lat for r in recs], [r.lon for r in recs],
+                                      [r.radius_km for r in recs], max_km)
+        return [(r, d) for r, d, ok in zip(recs, dists, mask) if ok]
+
+MATCHER = ExecutorIndex()
+
+async def _match_sql(cat: str, rlat: float, rlon: float, rr: float) -> List[Tuple]:
+    # SQLite-side matching, used when the in-memory index is not loaded
+    if GEO_INDEX:
+        # the R*Tree box drives the lookup (CROSS JOIN pins the order), category is a PK probe;
+        # exact distance checks below
+        rows = await DB.fetchall(
+            f"SELECT e.id, e.user_id, e.pending_username, e.direct_tg_id, e.city, e.lat, e.lon, e.radius_km, e.is_owner, {EXEC_CHAT_ID_SQL} "
+            "FROM executors_geo g CROSS JOIN executor_categories c ON c.executor_id=g.id AND c.category=? JOIN executors e ON e.id=g.id "
+            "LEFT JOIN users u ON u.id=e.user_id WHERE g.max_lat>=? AND g.min_lat<=? AND g.max_lon>=? AND g.min_lon<=? AND e.is_active=1",
+            (cat, *bbox_km(rlat, rlon, rr))
         )
-        rows = await cur.fetchall()
+    else:
+        rows = await DB.fetchall(
+            f"SELECT e.id, e.user_id, e.pending_username, e.direct_tg_id, e.city, e.lat, e.lon, e.radius_km, e.is_owner, {EXEC_CHAT_ID_SQL} "
+            "FROM executor_categories c JOIN executors e ON e.id=c.executor_id LEFT JOIN users u ON u.id=e.user_id "
+            "WHERE c.category=? AND e.is_active=1",
+            (cat,)
+        )
+    rows = [row for row in rows if row[5] is not None and row[6] is not None]
+    dists, mask = haversine_batch(rlat, rlon, [row[5] for row in rows], [row[6] for row in rows],
+                                  [row[7] for row in rows], rr)
     matches = []
-    for row in rows:
-        exec_id, user_id, pending_username, direct_tg_id, cats, city, elat, elon, eradius, is_owner = row
-        if not cats: continue
-        if cat not in [c.strip() for c in cats.split(",")]:
-            continue
-        if elat is None or elon is None:
-            continue
-        dist = haversine_km(rlat, rlon, elat, elon)
-        if dist <= eradius and dist <= rr:
-            matches.append((exec_id, user_id, pending_username, direct_tg_id, dist, is_owner, city))
+    for row, dist, ok in zip(rows, dists, mask):
+        if ok:
+            exec_id, user_id, pending_username, direct_tg_id, city, elat, elon, eradius, is_owner, chat_id = row
+            matches.append((exec_id, user_id, pending_username, direct_tg_id, dist, is_owner, city, chat_id))
+    return matches
+
+@observe("db")
+async def find_candidates(req_id: int) -> List[Tuple]:
+    r = await DB.fetchone("SELECT category, lat, lon, client_radius_km FROM requests WHERE id=?", (req_id,))
+    if not r: return []
+    return await find_matches(*r)
+
+@observe("db")
+async def find_matches(cat: str, rlat: float, rlon: float, rr: float) -> List[Tuple]:
+    # candidates for a request that may not be stored yet, in find_candidates() order
+    if MATCHER.loaded:
+        matches = [(e.id, e.user_id, e.pending_username, e.direct_tg_id, dist, e.is_owner, e.city, e.chat_id)
+                   for e, dist in MATCHER.match(cat, rlat, rlon, rr)]
+    else:
+        matches = await _match_sql(cat, rlat, rlon, rr)
     prefer_owner = await settings_get()
     matches.sort(key=lambda x: (0 if (prefer_owner and x[5]) else 1, x[4]))
     return matches
 
-async def create_offer(request_id: int, executor_id: int, rate_type: str, rate_value: float, comment: str) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
+@observe("db")
+async def create_auction_request(client_user_id: int, category: str, description: str, address_text: str,
+                                 lat: float, lon: float, radius_km: float, candidates: List[Tuple]) -> Tuple[int, int]:
+    # stores the request and queues one invite per reachable candidate in the same transaction;
+    # returns (request_id, invites queued)
+    async with DB.transaction() as db:
+        cur = await db.execute(
+            "INSERT INTO requests(client_user_id, category, description, address_text, city, lat, lon, client_radius_km, mode, status, created_at) "
+            "VALUES(?,?,?,?,'',?,?,?,'auction','published',?)",
+            (client_user_id, category, description, address_text, lat, lon, radius_km, datetime.utcnow().isoformat())
+        )
+        req_id = cur.lastrowid
+        invites = [(chat_id, *invite_notice(req_id, exid, dist))
+                   for exid, user_id, pun, direct_tg_id, dist, is_owner, city, chat_id in candidates if chat_id]
+        await OUTBOX.put_many(db, "invite", invites, ref_id=req_id)
+    return req_id, len(invites)
+
+@observe("db")
+async def create_offer_notify(request_id: int, executor_id: int, rate_type: str, rate_value: float, comment: str) -> int:
+    # inserts the offer and queues the client's notice in the same transaction, coalesced with
+    # the client's other offers of the current digest window
+    async with DB.transaction() as db:
+        cur = await db.execute(
             "INSERT INTO offers(request_id, executor_id, rate_type, rate_value, comment, status, created_at) "
             "VALUES(?,?,?,?,?,'active',?)",
             (request_id, executor_id, rate_type, rate_value, comment, datetime.utcnow().isoformat())
         )
-        await db.commit()
-        cur = await db.execute("SELECT last_insert_rowid()")
-        return (await cur.fetchone())[0]
+        offer_id = cur.lastrowid
+        rows = await db.execute_fetchall(
+            "SELECT u.tg_id FROM requests r JOIN users u ON u.id=r.client_user_id WHERE r.id=?", (request_id,))
+        if rows and rows[0][0]:
+            await OUTBOX.put_offer(db, rows[0][0], offer_id,
+                                   *offer_notice(request_id, offer_id, executor_id, rate_type, rate_value, comment))
+    return offer_id
+
+ACCEPTED_DEAL_SQL = (
+    "SELECT d.id, o.request_id, o.executor_id, e.user_id, e.direct_tg_id, eu.username, "
+    "COALESCE(eu.tg_id, e.direct_tg_id), r.client_user_id, cu.tg_id, cu.username "
+    "FROM deals d JOIN offers o ON o.id=d.offer_id "
+    "LEFT JOIN executors e ON e.id=o.executor_id LEFT JOIN users eu ON eu.id=e.user_id "
+    "LEFT JOIN requests r ON r.id=o.request_id LEFT JOIN users cu ON cu.id=r.client_user_id "
+    "WHERE d.offer_id=?"
+)
 
-async def set_offer_status(offer_id: int, status: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE offers SET status=? WHERE id=?", (status, offer_id))
-        await db.commit()
+@observe("db")
+async def accept_offer(offer_id: int) -> Optional[dict]:
+    # Accepts the offer, creates its deal with contacts released and queues the executor's
+    # notice, in one transaction. ux_deals_offer makes it idempotent: a repeat returns the
+    # existing deal with created=False. None if the offer does not exist.
+    row = await DB.fetchone(ACCEPTED_DEAL_SQL, (offer_id,))
+    created = False
+    if row is None:
+        async with DB.transaction() as db:
+            created = bool(await db.execute_fetchall(
+                "INSERT INTO deals(request_id, offer_id, contacts_released, created_at) "
+                "SELECT request_id, id, 1, ? FROM offers WHERE id=? "
+                "ON CONFLICT(offer_id) DO NOTHING RETURNING id",
+                (datetime.utcnow().isoformat(), offer_id)))
+            if created:
+                await db.execute("UPDATE offers SET status='accepted' WHERE id=?", (offer_id,))
+            rows = await db.execute_fetchall(ACCEPTED_DEAL_SQL, (offer_id,))
+            # only the first acceptance notifies the executor
+            if created and rows and rows[0][6] and rows[0][8]:
+                await OUTBOX.put(db, rows[0][6], "accepted", *accepted_notice(rows[0][1], rows[0][9]))
+        if not rows:
+            return None
+        row = rows[0]
+    keys = ("deal_id", "request_id", "executor_id", "exec_user_id", "direct_tg_id", "exec_username",
+            "exec_chat_id", "client_user_id", "client_chat_id", "client_username")
+    return dict(zip(keys, row), created=created)
+
+# ===== Outbound sending =====
+class Broadcaster:
+    # Sends under Telegram's limits (~30 msg/s per bot, ~1 msg/s per chat) with bounded
+    # concurrency; honours RetryAfter for everyone and retries transient network errors.
+    def __init__(self, rate: float, per_chat_rate: float, concurrency: int, attempts: int = 4):
+        self.bucket = TokenBucket(rate, capacity=rate)
+        self.per_chat_rate = per_chat_rate
+        self.chat_buckets: OrderedDict = OrderedDict()
+        self.sem = asyncio.Semaphore(concurrency)
+        self.attempts = attempts
+        self.paused_until = 0.0
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        b = self.chat_buckets.get(chat_id)
+        if b is None:
+            b = self.chat_buckets[chat_id] = TokenBucket(self.per_chat_rate)
+            if len(self.chat_buckets) > 10000:
+                self.chat_buckets.popitem(last=False)
+        else:
+            self.chat_buckets.move_to_end(chat_id)
+        return b
+
+    @observe("outbound", "broadcaster_send")
+    async def send(self, bot, chat_id: int, text: str, reply_markup=None) -> str:
+        # "sent", "blocked" (user blocked the bot), "failed" (rejected) or "retry" (still failing
+        # after the transient-error attempts); timed including the rate-limit waits
+        status = await self._send(bot, chat_id, text, reply_markup)
+        METRICS.inc("broker_outbound_messages_total", status=status)
+        return status
+
+    async def _send(self, bot, chat_id: int, text: str, reply_markup=None) -> str:
+        # Waits for the chat's bucket, a RetryAfter pause and the error backoff without holding a
+        # concurrency slot, so a burst to one chat cannot stall sends to the others; the slot
+        # only covers the global bucket and the API call.
+        for attempt in range(self.attempts):
+            await self._chat_bucket(chat_id).acquire()
+            delay = self.paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            async with self.sem:
+                await self.bucket.acquire()
+                try:
+                    await bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
+                    return "sent"
+                except RetryAfter as e:
+                    METRICS.inc("broker_telegram_retry_after_total")
+                    ra = e.retry_after
+                    wait = ra.total_seconds() if isinstance(ra, timedelta) else float(ra)
+                    self.paused_until = max(self.paused_until, time.monotonic() + wait)
+                    continue
+                except Forbidden:
+                    return "blocked"
+                except BadRequest as e:
+                    logging.warning("send to %s rejected: %s", chat_id, e)
+                    return "failed"
+                except NetworkError as e:  # includes TimedOut
+                    logging.info("send to %s failed (attempt %d): %s", chat_id, attempt + 1, e)
+                except Exception as e:
+                    logging.warning("send to %s failed: %s", chat_id, e)
+                    return "failed"
+            await asyncio.sleep(min(0.5 * 2 ** attempt, 10))
+        return "retry"
+
+BROADCASTER = Broadcaster(
+    rate=float(os.getenv("TG_GLOBAL_RPS", "25")),
+    per_chat_rate=float(os.getenv("TG_CHAT_RPS", "1")),
+    concurrency=int(os.getenv("BROADCAST_CONCURRENCY", "16")),
+)
 
-async def create_deal(request_id: int, offer_id: int) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT INTO deals(request_id, offer_id, contacts_released, created_at) VALUES(?,?,0,?)",
-            (request_id, offer_id, datetime.utcnow().isoformat())
-        )
-        await db.commit()
-        cur = await db.execute("SELECT last_insert_rowid()")
-        return (await cur.fetchone())[0]
+async def send_to_executor(context: ContextTypes.DEFAULT_TYPE, ex_row, text: str, reply_markup=None) -> bool:
+    # ex_row: a get_executor()/find_candidates() row, resolved chat_id last
+    chat_id = ex_row[-1]
+    if not chat_id:
+        return False
+    return await BROADCASTER.send(context.bot, chat_id, text, reply_markup) == "sent"
 
-async def release_contacts(deal_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE deals SET contacts_released=1 WHERE id=?", (deal_id,))
-        await db.commit()
+def invite_notice(req_id: int, exec_id: int, dist: float) -> Tuple[str, InlineKeyboardMarkup]:
+    text = (
+        f"Новая заявка #{req_id}\n"
+        f"Дистанция до объекта: ~{dist:.1f} км\n\n"
+        "Отправьте предложение:"
+    )
+    kb = InlineKeyboardMarkup.from_button(
+        InlineKeyboardButton(f"Откликнуться на #{req_id}", callback_data=f"offer:{req_id}:{exec_id}")
+    )
+    return text, kb
+
+def offer_notice(req_id: int, offer_id: int, exec_id: int, rate_type: str, rate_value: float,
+                 comment: str) -> Tuple[str, InlineKeyboardMarkup]:
+    text = (
+        f"Новый оффер по заявке #{req_id}\n"
+        f"Тип ставки: {rate_type}\nСтавка: {rate_value}\nКомментарий: {comment or '—'}\n"
+        f"Исполнитель: E-{exec_id:05d} (скрыто)\n\n"
+        "Если вас устраивает — нажмите «Принять оффер». Контакты откроются."
+    )
+    kb = InlineKeyboardMarkup.from_button(
+        InlineKeyboardButton("Принять оффер", callback_data=f"accept_offer:{offer_id}")
+    )
+    return text, kb
+
+DIGEST_MAX_OFFERS = 10  # per message, keeps a digest under Telegram's 4096 characters
 
-async def tg_id_by_user_id(user_id: int) -> Optional[int]:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT tg_id FROM users WHERE id=?", (user_id,))
-        row = await cur.fetchone()
+def offer_digest(offers) -> Tuple[str, InlineKeyboardMarkup]:
+    # offers: (offer_id, request_id, executor_id, rate_type, rate_value, comment)
+    lines = [f"Новые офферы ({len(offers)}):"]
+    buttons = []
+    for oid, req_id, exec_id, rate_type, rate_value, comment in offers:
+        comment = comment or "—"
+        if len(comment) > 80:
+            comment = comment[:79] + "…"
+        lines.append(f"\n#{oid} по заявке #{req_id}: {rate_value} ({rate_type}), E-{exec_id:05d} (скрыто)\n{comment}")
+        buttons.append([InlineKeyboardButton(f"Принять #{oid} (заявка #{req_id})", callback_data=f"accept_offer:{oid}")])
+    lines.append("\nНажмите «Принять» у подходящего оффера — контакты откроются.")
+    return "\n".join(lines), InlineKeyboardMarkup(buttons)
+
+def accepted_notice(req_id: int, client_username: Optional[str]) -> Tuple[str, None]:
+    return f"Ваш оффер принят по заявке #{req_id}. Контакты клиента: @{client_username or ''}", None
+
+class Outbox:
+    # Durable queue of outgoing notifications. Writers call put()/put_many()/put_offer() with the connection
+    # of their own transaction, so a notice exists iff its business row does. One background
+    # task drains due rows in batches through BROADCASTER and records the outcome; transient
+    # failures are retried with exponential backoff up to max_attempts. Delivery is
+    # at-least-once: a crash between a send and its status update resends that message.
+    def __init__(self, batch: int, max_attempts: int, keep_days: float):
+        self.batch = batch
+        self.max_attempts = max_attempts
+        self.keep_s = keep_days * 86400
+        self.task: Optional[asyncio.Task] = None
+        self._wake = asyncio.Event()
+        self._stopping = False
+        self._purged_at = 0.0
+
+    async def put(self, db, chat_id: int, kind: str, text: str, reply_markup=None):
+        await self.put_many(db, kind, [(chat_id, text, reply_markup)])
+
+    async def put_many(self, db, kind: str, items, ref_id: Optional[int] = None):
+        # items: (chat_id, text, reply_markup), due now; ref_id tags a fan-out for report()
+        now = time.time()
+        await self._insert(db, kind, [(chat_id, text, reply_markup, now, ref_id) for chat_id, text, reply_markup in items])
+
+    async def put_offer(self, db, chat_id: int, offer_id: int, text: str, reply_markup, window: Optional[float] = None):
+        # joins the client's open digest window (its pending offers share one next_at) or opens a
+        # new one; text/reply_markup are used as-is if the offer ends up alone in its window.
+        # Rows already retried are left out: backoff moved their next_at up to an hour away.
+        rows = await db.execute_fetchall(
+            "SELECT MIN(next_at) FROM outbox WHERE chat_id=? AND kind='offer' AND status='pending' AND attempts=0",
+            (chat_id,))
+        due = rows[0][0] if rows and rows[0][0] is not None else None
+        if due is None:
+            due = time.time() + (OFFER_DIGEST_WINDOW if window is None else window)
+        await self._insert(db, "offer", [(chat_id, text, reply_markup, due, offer_id)])
+
+    async def _insert(self, db, kind: str, items):
+        # the worker is woken right away and its fetch waits for the writer lock, so it sees
+        # the rows as soon as the caller commits
+        if not items:
+            return
+        created = datetime.utcnow().isoformat()
+        await db.executemany(
+            "INSERT INTO outbox(chat_id, kind, text, reply_markup, next_at, ref_id, created_at) VALUES(?,?,?,?,?,?,?)",
+            [(chat_id, kind, text, reply_markup.to_json() if reply_markup else None, due, ref_id, created)
+             for chat_id, text, reply_markup, due, ref_id in items])
+        METRICS.inc("broker_outbox_enqueued_total", len(items), kind=kind)
+        self._wake.set()
+
+    async def _deliver(self, bot, job) -> Tuple[List[int], str]:
+        ids, chat_id, text, markup = job
+        if isinstance(markup, str):
+            markup = InlineKeyboardMarkup.de_json(json.loads(markup), bot)
+        return ids, await BROADCASTER.send(bot, chat_id, text, markup)
+
+    async def _jobs(self, db, rows, now: float) -> Tuple[list, List[int]]:
+        # one job per row, except that a client's due offers are merged into digests;
+        # returns (jobs of (outbox ids, chat_id, text, markup), ids of offers that no longer exist)
+        jobs, offers = [], defaultdict(list)
+        for r in rows:
+            if r[2] == "offer":
+                offers[r[1]].append(r)
+            else:
+                jobs.append(([r[0]], r[1], r[3], r[4]))
+        if offers:
+            # the rest of those clients' windows, in case the batch limit cut one short
+            chats = list(offers)
+            seen = {r[0] for r in rows}
+            for r in await db.execute_fetchall(
+                    f"SELECT id, chat_id, kind, text, reply_markup, ref_id FROM outbox "
+                    f"WHERE chat_id IN ({','.join('?' * len(chats))}) AND kind='offer' AND status='pending' "
+                    f"AND attempts=0 AND next_at<=? ORDER BY id", (*chats, now)):
+                if r[0] not in seen:
+                    offers[r[1]].append(r)
+        refs = [r[5] for group in offers.values() if len(group) > 1 for r in group]
+        details = {}
+        if refs:
+            details = {d[0]: d for d in await db.execute_fetchall(
+                f"SELECT id, request_id, executor_id, rate_type, rate_value, comment FROM offers "
+                f"WHERE id IN ({','.join('?' * len(refs))})", refs)}
+        gone = []
+        for chat_id, group in offers.items():
+            if len(group) == 1:
+                r = group[0]
+                jobs.append(([r[0]], chat_id, r[3], r[4]))
+                continue
+            group.sort(key=lambda r: r[0])
+            gone += [r[0] for r in group if r[5] not in details]
+            items = [(r[0], details[r[5]]) for r in group if r[5] in details]
+            for i in range(0, len(items), DIGEST_MAX_OFFERS):
+                chunk = items[i:i + DIGEST_MAX_OFFERS]
+                METRICS.inc("broker_outbox_digest_offers_total", len(chunk))
+                jobs.append(([oid for oid, _ in chunk], chat_id, *offer_digest([d for _, d in chunk])))
+        return jobs, gone
+
+    async def drain_once(self, bot) -> int:
+        # sends one batch of due messages; returns how many outbox rows were handled
+        now = time.time()
+        async with DB.transaction() as db:
+            rows = await db.execute_fetchall(
+                "SELECT id, chat_id, kind, text, reply_markup, ref_id FROM outbox WHERE status='pending' AND next_at<=? "
+                "ORDER BY next_at, id LIMIT ?", (now, self.batch))
+            if not rows:
+                return 0
+            jobs, gone = await self._jobs(db, rows, now)
+        results = await asyncio.gather(*(self._deliver(bot, j) for j in jobs))
+        sent_at = datetime.utcnow().isoformat()
+        done = [("failed", None, "gone", oid) for oid in gone]
+        retry = []
+        for ids, status in results:
+            METRICS.inc("broker_outbox_attempts_total", status=status)
+            if status == "retry":
+                retry += ids
+            else:
+                done += [(status, sent_at if status == "sent" else None, None if status == "sent" else status, oid)
+                         for oid in ids]
+        async with DB.transaction() as db:
+            await db.executemany(
+                "UPDATE outbox SET status=?, attempts=attempts+1, sent_at=?, last_error=? WHERE id=?", done)
+            for oid in retry:
+                await db.execute(
+                    "UPDATE outbox SET attempts=attempts+1, last_error='retry', "
+                    "status=CASE WHEN attempts+1>=? THEN 'failed' ELSE 'pending' END, "
+                    "next_at=?+MIN(3600, 5*(1<<MIN(attempts, 12))) WHERE id=?",
+                    (self.max_attempts, time.time(), oid))
+            if time.time() - self._purged_at > 3600:
+                self._purged_at = time.time()
+                cutoff = (datetime.utcnow() - timedelta(seconds=self.keep_s)).isoformat()
+                await db.execute("DELETE FROM outbox WHERE created_at<? AND status!='pending'", (cutoff,))
+        return len(done) + len(retry)
+
+    async def _next_due(self) -> Optional[float]:
+        row = await DB.fetchone("SELECT MIN(next_at) FROM outbox WHERE status='pending'")
         return row[0] if row else None
 
-async def username_by_user_id(user_id: Optional[int]) -> str:
-    if not user_id: return ""
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT username FROM users WHERE id=?", (user_id,))
-        row = await cur.fetchone()
-        return (row[0] or "") if row else ""
+    async def run(self, bot):
+        while not self._stopping:
+            self._wake.clear()
+            try:
+                if await self.drain_once(bot):
+                    continue
+                due = await self._next_due()
+            except Exception:
+                logging.exception("outbox drain failed")
+                due = None
+            timeout = 5.0 if due is None else min(5.0, max(0.05, due - time.time()))
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self, bot):
+        if self.task is None:
+            self._stopping = False
+            self.task = asyncio.get_running_loop().create_task(self.run(bot))
 
-async def send_to_executor(context: ContextTypes.DEFAULT_TYPE, ex_row, text: str, reply_markup=None) -> bool:
-    ex_id, user_id, pending_username, direct_tg_id, *_ = ex_row
-    chat_id = None
-    if user_id:
-        chat_id = await tg_id_by_user_id(user_id)
-    if not chat_id and direct_tg_id:
-        chat_id = direct_tg_id
-    if not chat_id:
-        return False
-    try:
-        await context.bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
-        return True
-    except Exception:
-        return False
+    async def stop(self, timeout: float = 10.0):
+        # lets the batch in flight finish so its statuses are recorded
+        if self.task is None:
+            return
+        self._stopping = True
+        self._wake.set()
+        try:
+            await asyncio.wait_for(self.task, timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.task = None
+
+    async def report(self, ref_id: int, kind: str = "invite") -> dict:
+        # delivery report of one fan-out: sent/failed/blocked, retry (failed attempts, still
+        # queued) and pending (not tried yet); rows are purged after keep_days
+        report = dict.fromkeys(("sent", "failed", "blocked", "retry", "pending"), 0)
+        for status, tried, n in await DB.fetchall(
+                "SELECT status, attempts>0, COUNT(*) FROM outbox WHERE ref_id=? AND kind=? GROUP BY status, attempts>0",
+                (ref_id, kind)):
+            if status == "pending":
+                report["retry" if tried else "pending"] += n
+            else:
+                report[status] += n
+        return report
+
+    async def summary(self) -> str:
+        rows = await DB.fetchall("SELECT status, kind, COUNT(*) FROM outbox GROUP BY status, kind")
+        oldest = await DB.fetchone("SELECT MIN(created_at) FROM outbox WHERE status='pending'")
+        if not rows:
+            return "Очередь уведомлений пуста."
+        by_status: dict = {}
+        for status, kind, n in rows:
+            by_status.setdefault(status, []).append(f"{kind} {n}")
+        lines = [f"{status}: {', '.join(parts)}" for status, parts in sorted(by_status.items())]
+        if oldest and oldest[0]:
+            lines.append(f"самое старое в очереди: {oldest[0].split('.')[0]}")
+        return "Очередь уведомлений:\n" + "\n".join(lines)
+
+OUTBOX = Outbox(OUTBOX_BATCH, OUTBOX_MAX_ATTEMPTS, OUTBOX_KEEP_DAYS)
+
+# ===== Persistence (conversation state & user_data) =====
+class SQLitePersistence(BasePersistence):
+    # Keeps ConversationHandler states and context.user_data in broker.db. The update_* hooks
+    # only record the new value in memory (PTB calls them every update_interval seconds for the
+    # entries touched since the last run); the pending set is then written in one transaction,
+    # so a persistence cycle costs one commit regardless of how many users were active.
+    def __init__(self, update_interval: float = 30):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True,
+                                                     callback_data=False), update_interval=update_interval)
+        self._user_data: Optional[dict] = None
+        self._conversations: dict = {}
+        self._pending_users: dict = {}  # user_id -> dict, or None to delete
+        self._pending_convs: dict = {}  # (name, key) -> state, or None to delete
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+        self.stats = {"flushes": 0, "rows": 0, "flush_ms": 0.0}
+
+    @staticmethod
+    def _conv_key(key) -> str:
+        return json.dumps(list(key))
+
+    async def get_user_data(self) -> dict:
+        if self._user_data is None:
+            rows = await DB.fetchall("SELECT user_id, data FROM bot_user_data")
+            self._user_data = {uid: json.loads(data) for uid, data in rows}
+        return {uid: dict(data) for uid, data in self._user_data.items()}
+
+    async def get_chat_data(self) -> dict:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        if name not in self._conversations:
+            rows = await DB.fetchall("SELECT key, state FROM bot_conversations WHERE name=?", (name,))
+            self._conversations[name] = {tuple(json.loads(k)): json.loads(st) for k, st in rows}
+        return dict(self._conversations[name])
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        conv = self._conversations.setdefault(name, {})
+        if new_state is None:
+            if conv.pop(key, None) is None:
+                return
+        elif conv.get(key) == new_state:
+            return
+        else:
+            conv[key] = new_state
+        self._pending_convs[(name, key)] = new_state
+        self._schedule_flush()
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        if self._user_data is None:
+            self._user_data = {}
+        if self._user_data.get(user_id) == data:
+            return
+        self._user_data[user_id] = data
+        self._pending_users[user_id] = data
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        if self._user_data is not None:
+            self._user_data.pop(user_id, None)
+        self._pending_users[user_id] = None
+        self._schedule_flush()
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        pass
+
+    async def update_bot_data(self, data) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+    def _schedule_flush(self):
+        # PTB gathers all update_* calls of one cycle; the task runs after all of them
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self.flush())
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self._pending_users and not self._pending_convs:
+                return
+            users, self._pending_users = self._pending_users, {}
+            convs, self._pending_convs = self._pending_convs, {}
+            t0 = time.perf_counter()
+            now = datetime.utcnow().isoformat()
+            try:
+                async with DB.transaction() as db:
+                    await db.executemany(
+                        "INSERT INTO bot_user_data(user_id, data, updated_at) VALUES(?,?,?) "
+                        "ON CONFLICT(user_id) DO UPDATE SET data=excluded.data, updated_at=excluded.updated_at",
+                        [(uid, json.dumps(d, ensure_ascii=False, default=str), now) for uid, d in users.items() if d is not None])
+                    await db.executemany("DELETE FROM bot_user_data WHERE user_id=?",
+                                         [(uid,) for uid, d in users.items() if d is None])
+                    await db.executemany(
+                        "INSERT INTO bot_conversations(name, key, state, updated_at) VALUES(?,?,?,?) "
+                        "ON CONFLICT(name, key) DO UPDATE SET state=excluded.state, updated_at=excluded.updated_at",
+                        [(n, self._conv_key(k), json.dumps(st), now) for (n, k), st in convs.items() if st is not None])
+                    await db.executemany("DELETE FROM bot_conversations WHERE name=? AND key=?",
+                                         [(n, self._conv_key(k)) for (n, k), st in convs.items() if st is None])
+            except Exception:
+                # keep the batch for the next cycle unless newer values arrived meanwhile
+                for uid, d in users.items():
+                    self._pending_users.setdefault(uid, d)
+                for ck, st in convs.items():
+                    self._pending_convs.setdefault(ck, st)
+                raise
+            self.stats["flushes"] += 1
+            self.stats["rows"] += len(users) + len(convs)
+            self.stats["flush_ms"] += (time.perf_counter() - t0) * 1000
+
+    def summary(self) -> str:
+        s = self.stats
+        avg_ms = s["flush_ms"] / s["flushes"] if s["flushes"] else 0.0
+        return (f"persistence: user_data {len(self._user_data or {})}, диалогов "
+                f"{sum(len(c) for c in self._conversations.values())}, сбросов {s['flushes']} "
+                f"({s['rows']} строк, среднее {avg_ms:.1f} мс), в очереди "
+                f"{len(self._pending_users) + len(self._pending_convs)}")
+
+PERSISTENCE = SQLitePersistence(update_interval=PERSIST_INTERVAL)
+
+# ===== Session housekeeping =====
+def _deep_size(obj, seen=None) -> int:
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_size(k, seen) + _deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(_deep_size(v, seen) for v in obj)
+    return size
+
+class SessionSweeper:
+    # Conversation timeouts without the JobQueue extra: every update stamps its user's last
+    # activity, and every SWEEP_INTERVAL seconds users idle for longer than CONV_TIMEOUT have
+    # their conversations ended and their user_data dropped (both also leave the persistence).
+    def __init__(self, timeout: float, interval: float):
+        self.timeout = timeout
+        self.interval = interval
+        self.last_seen: dict = {}  # user_id -> time.monotonic() of the last update
+        self.task: Optional[asyncio.Task] = None
+        self.stats = {"sweeps": 0, "conversations": 0, "users": 0}
+
+    async def touch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if update.effective_user:
+            self.last_seen[update.effective_user.id] = time.monotonic()
+
+    @staticmethod
+    def _conversations(app) -> List[ConversationHandler]:
+        return [h for hs in app.handlers.values() for h in hs if isinstance(h, ConversationHandler)]
+
+    def seed(self, app, now: Optional[float] = None):
+        # users restored from the persistence (or seen only in a conversation) start their clock
+        # now; without an entry a user who never writes again would keep them forever
+        now = time.monotonic() if now is None else now
+        for uid in app.user_data:
+            self.last_seen.setdefault(uid, now)
+        for conv in self._conversations(app):
+            if conv.per_user:
+                pos = 1 if conv.per_chat else 0
+                for key in conv._conversations:
+                    self.last_seen.setdefault(key[pos], now)
+
+    def sweep(self, app, now: Optional[float] = None) -> Tuple[int, int]:
+        now = time.monotonic() if now is None else now
+        cutoff = now - self.timeout
+        self.seed(app, now)
+        stale = {uid for uid, ts in self.last_seen.items() if ts < cutoff}
+        ended = 0
+        if stale:
+            for conv in self._conversations(app):
+                if not conv.per_user:
+                    continue
+                pos = 1 if conv.per_chat else 0
+                # ConversationHandler has no public API for ending someone else's conversation;
+                # popping from its TrackingDict is what its own timeout does, and is persisted too
+                states = conv._conversations
+                for key in [k for k in states if k[pos] in stale]:
+                    states.pop(key)
+                    ended += 1
+            for uid in stale:
+                if uid in app.user_data:
+                    app.drop_user_data(uid)
+                del self.last_seen[uid]
+        self.stats["sweeps"] += 1
+        self.stats["conversations"] += ended
+        self.stats["users"] += len(stale)
+        return ended, len(stale)
+
+    async def run(self, app):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                ended, users = self.sweep(app)
+                if users:
+                    logging.info("session sweep: %s idle users, %s conversations ended", users, ended)
+            except Exception:
+                logging.exception("session sweep failed")
+
+    def start(self, app):
+        # called from post_init, once the persisted conversations and user_data are loaded
+        if self.task is None:
+            self.seed(app)
+            self.task = asyncio.get_running_loop().create_task(self.run(app))
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def memory_report(self, app, top: int = 10) -> str:
+        sizes = sorted(((_deep_size(d), uid) for uid, d in app.user_data.items()), reverse=True)
+        total = sum(sz for sz, _ in sizes)
+        convs = ", ".join(f"{c.name}: {len(c._conversations)}" for c in self._conversations(app) if c.name)
+        lines = [
+            f"user_data: {len(sizes)} пользователей, ~{total / 1024:.1f} КБ"
+            + (f", в среднем {total / len(sizes):.0f} Б" if sizes else ""),
+            f"диалоги: {convs or 'нет'}",
+            f"очистка: раз в {self.interval:.0f} с, таймаут {self.timeout:.0f} с; "
+            f"проходов {self.stats['sweeps']}, вытеснено пользователей {self.stats['users']}, "
+            f"диалогов {self.stats['conversations']}",
+        ]
+        lines += [f"  {uid}: {sz} Б, ключи: {', '.join(map(str, app.user_data[uid])) or '—'}" for sz, uid in sizes[:top] if sz]
+        return "\n".join(lines)
+
+SWEEPER = SessionSweeper(CONV_TIMEOUT, SWEEP_INTERVAL)
 
 # ===== Conversations =====
 ROLE_SEL, MODE_SEL, CAT_SEL, DESC_IN, ADDR_IN, GEO_PICK, RAD_IN = range(7)
@@ -514,6 +2143,25 @@ async def radius_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return RAD_IN
     context.user_data["req_radius"] = r
     client_uid = await get_or_create_user(update.effective_user, role="client")
+    mode = context.user_data.get("req_mode","auction")
+    after_kb = InlineKeyboardMarkup([
+        [InlineKeyboardButton("Создать ещё", callback_data="imenu:new")],
+        [InlineKeyboardButton("Мои заявки", callback_data="imenu:my")],
+        [InlineKeyboardButton(L_HOME + " (сброс)", callback_data="imenu:home")]
+    ])
+    if mode == "auction":
+        ud = context.user_data
+        candidates = await find_matches(ud["req_cat"], ud["req_lat"], ud["req_lon"], r)
+        # the request and its invites are stored together; the outbox worker sends the invites
+        req_id, invites = await create_auction_request(
+            client_uid, ud["req_cat"], ud["req_desc"], ud.get("req_addr_resolved") or ud.get("req_addr") or "",
+            ud["req_lat"], ud["req_lon"], r, candidates)
+        context.user_data.clear()
+        if invites:
+            await update.message.reply_text(f"Заявка #{req_id} создана. Рассылаю исполнителям…", reply_markup=after_kb)
+        else:
+            await update.message.reply_text(f"Заявка #{req_id} создана.\nПодходящих исполнителей не найдено.", reply_markup=after_kb)
+        return ConversationHandler.END
     req_id = await new_request(
         client_user_id=client_uid,
         category=context.user_data["req_cat"],
@@ -524,47 +2172,19 @@ async def radius_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
         radius_km=context.user_data["req_radius"],
         mode=context.user_data.get("req_mode","auction")
     )
-    mode = context.user_data.get("req_mode","auction")
     context.user_data.clear()
-    after_kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("Создать ещё", callback_data="imenu:new")],
-        [InlineKeyboardButton("Мои заявки", callback_data="imenu:my")],
-        [InlineKeyboardButton(L_HOME + " (сброс)", callback_data="imenu:home")]
-    ])
-    if mode == "auction":
-        await update.message.reply_text(f"Заявка #{req_id} создана. Рассылаю исполнителям…", reply_markup=after_kb)
-        candidates = await find_candidates(req_id)
-        if candidates:
-            for row in candidates:
-                exid, user_id, pun, direct_tg_id, dist, is_owner, city = row
-                text = (
-                    f"Новая заявка #{req_id}\n"
-                    f"Дистанция до объекта: ~{dist:.1f} км\n\n"
-                    "Отправьте предложение:"
-                )
-                kb = InlineKeyboardMarkup.from_button(
-                    InlineKeyboardButton(f"Откликнуться на #{req_id}", callback_data=f"offer:{req_id}:{exid}")
-                )
-                try:
-                    await send_to_executor(context, (exid, user_id, pun, direct_tg_id), text, kb)
-                except Exception:
-                    pass
-        else:
-            await update.message.reply_text("Подходящих исполнителей не найдено.", reply_markup=after_kb)
-        return ConversationHandler.END
-    else:
-        candidates = await find_candidates(req_id)
-        if not candidates:
-            await update.message.reply_text("Исполнителей в радиусе не найдено.", reply_markup=after_kb)
-            return ConversationHandler.END
-        lines = ["Нашёл исполнителей (сначала свои, затем по расстоянию):"]
-        buttons = []
-        for exid, user_id, pun, direct_tg_id, dist, is_owner, city in candidates[:20]:
-            lines.append(f"E-{exid:05d} | {city or '—'} | ~{dist:.1f} км | {'СВОЙ' if is_owner else 'подряд'}")
-            buttons.append([InlineKeyboardButton(f"Запросить оффер у E-{exid:05d}", callback_data=f"req_offer:{req_id}:{exid}")])
-        await update.message.reply_text("\n".join(lines), reply_markup=InlineKeyboardMarkup(buttons))
-        await update.message.reply_text("Готово. Можно вернуться в начало:", reply_markup=after_kb)
+    candidates = await find_candidates(req_id)
+    if not candidates:
+        await update.message.reply_text("Исполнителей в радиусе не найдено.", reply_markup=after_kb)
         return ConversationHandler.END
+    lines = ["Нашёл исполнителей (сначала свои, затем по расстоянию):"]
+    buttons = []
+    for exid, user_id, pun, direct_tg_id, dist, is_owner, city, chat_id in candidates[:20]:
+        lines.append(f"E-{exid:05d} | {city or '—'} | ~{dist:.1f} км | {'СВОЙ' if is_owner else 'подряд'}")
+        buttons.append([InlineKeyboardButton(f"Запросить оффер у E-{exid:05d}", callback_data=f"req_offer:{req_id}:{exid}")])
+    await update.message.reply_text("\n".join(lines), reply_markup=InlineKeyboardMarkup(buttons))
+    await update.message.reply_text("Готово. Можно вернуться в начало:", reply_markup=after_kb)
+    return ConversationHandler.END
 
 # --- Catalog: request offer from specific executor
 async def on_request_offer(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -636,25 +2256,8 @@ async def on_offer_comment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     exid = context.user_data["offer_exec_id"]
     rt = context.user_data["rate_type"]
     rv = context.user_data["rate_value"]
-    offer_id = await create_offer(rid, exid, rt, rv, comment)
-    req = await get_request(rid)
-    if req:
-        _, client_user_id, category, desc, addr, city, lat, lon, crad, mode, status, _ = req
-        client_tg = await tg_id_by_user_id(client_user_id)
-        if client_tg:
-            kb = InlineKeyboardMarkup.from_button(
-                InlineKeyboardButton("Принять оффер", callback_data=f"accept_offer:{offer_id}")
-            )
-            await context.bot.send_message(
-                chat_id=client_tg,
-                text=(
-                    f"Новый оффер по заявке #{rid}\n"
-                    f"Тип ставки: {rt}\nСтавка: {rv}\nКомментарий: {comment or '—'}\n"
-                    f"Исполнитель: E-{exid:05d} (скрыто)\n\n"
-                    "Если вас устраивает — нажмите «Принять оффер». Контакты откроются."
-                ),
-                reply_markup=kb
-            )
+    # the client is notified by the outbox worker once the offer is committed
+    await create_offer_notify(rid, exid, rt, rv, comment)
     await update.message.reply_text("Оффер отправлен заказчику.", reply_markup=inline_main_menu())
     return ConversationHandler.END
 
@@ -664,93 +2267,173 @@ async def on_accept_offer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await q.answer()
     _, sid = q.data.split(":")
     offer_id = int(sid)
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT o.request_id, o.executor_id, e.user_id, e.direct_tg_id FROM offers o "
-            "LEFT JOIN executors e ON e.id=o.executor_id WHERE o.id=?", (offer_id,)
-        )
-        row = await cur.fetchone()
-    if not row:
+    deal = await accept_offer(offer_id)
+    if not deal:
         await q.message.reply_text("Оффер не найден.", reply_markup=inline_main_menu())
         return
-    request_id, exec_id, exec_user_id, direct_tg_id = row
-    await set_offer_status(offer_id, "accepted")
-    deal_id = await create_deal(request_id, offer_id)
-    await release_contacts(deal_id)
     contact = ""
-    if exec_user_id:
-        uname = await username_by_user_id(exec_user_id)
-        if uname: contact = f"@{uname}"
-    elif direct_tg_id:
-        contact = f"tg://user?id={direct_tg_id}"
-    await q.message.reply_text(f"Оффер принят. Сделка #{deal_id}.\nКонтакты исполнителя: {contact or 'появятся после /start'}",
+    if deal["exec_user_id"]:
+        if deal["exec_username"]: contact = f"@{deal['exec_username']}"
+    elif deal["direct_tg_id"]:
+        contact = f"tg://user?id={deal['direct_tg_id']}"
+    head = f"Оффер принят. Сделка #{deal['deal_id']}." if deal["created"] else f"Оффер уже принят. Сделка #{deal['deal_id']}."
+    await q.message.reply_text(f"{head}\nКонтакты исполнителя: {contact or 'появятся после /start'}",
                                reply_markup=inline_main_menu())
-    req = await get_request(request_id)
-    if req:
-        _, client_user_id, *_ = req
-        client_tg = await tg_id_by_user_id(client_user_id)
-        if client_tg:
-            try:
-                if exec_user_id:
-                    ex_tg = await tg_id_by_user_id(exec_user_id)
-                else:
-                    ex_tg = direct_tg_id
-                if ex_tg:
-                    uname_client = await username_by_user_id(client_user_id)
-                    await context.bot.send_message(ex_tg, f"Ваш оффер принят по заявке #{request_id}. Контакты клиента: @{uname_client or ''}")
-            except Exception:
-                pass
 
 # --- My Requests (inline)
-async def cmd_my_inline(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    uid = await get_or_create_user(update.effective_user, role="client")
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(
-            "SELECT id, category, address_text, mode, status, created_at FROM requests WHERE client_user_id=? ORDER BY id DESC LIMIT 10",
-            (uid,)
-        )
-        rows = await cur.fetchall()
+MY_PAGE_SIZE = 10
+OFFERS_PAGE_SIZE = 5
+
+def page_nav(prefix: str, rows, has_older: bool, has_newer: bool) -> List[InlineKeyboardButton]:
+    nav = []
+    if has_newer:
+        nav.append(InlineKeyboardButton("« Новее", callback_data=f"{prefix}:newer:{rows[0][0]}"))
+    if has_older:
+        nav.append(InlineKeyboardButton("Старее »", callback_data=f"{prefix}:older:{rows[-1][0]}"))
+    return nav
+
+async def show_page(q, text: str, kb: InlineKeyboardMarkup):
+    # pages replace the message they were opened from; one that can no longer be edited gets a new one
+    try:
+        await q.message.edit_text(text, reply_markup=kb)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            await q.message.reply_text(text, reply_markup=kb)
+
+async def my_requests_page(uid: int, cursor: int = 0, newer: bool = False) -> Optional[Tuple[str, InlineKeyboardMarkup]]:
+    async with DB.reader() as db:
+        rows, has_older, has_newer = await keyset_page(
+            db, "SELECT id, category, address_text, mode, status, created_at FROM requests", "client_user_id=?",
+            (uid,), cursor, newer, MY_PAGE_SIZE)
         # count offers per request
         offers_count = {}
         if rows:
             ids = tuple([r[0] for r in rows])
             in_clause = ",".join(["?"]*len(ids))
-            cur = await db.execute(f"SELECT request_id, COUNT(*) FROM offers WHERE request_id IN ({in_clause}) GROUP BY request_id", ids)
-            for rid, cnt in await cur.fetchall():
+            for rid, cnt in await db.execute_fetchall(f"SELECT request_id, COUNT(*) FROM offers WHERE request_id IN ({in_clause}) GROUP BY request_id", ids):
                 offers_count[rid] = cnt
     if not rows:
-        await update.callback_query.message.reply_text("Пока нет заявок.", reply_markup=inline_main_menu())
-        return
-    lines = ["Ваши последние заявки:"]
+        return None
+    lines = ["Ваши заявки:" if has_newer else "Ваши последние заявки:"]
     buttons = []
     for rid, cat, addr, mode, status, created_at in rows:
         created = created_at.split("T")[0] if created_at else ""
         cnt = offers_count.get(rid, 0)
         lines.append(f"#{rid} · {created} · {cat} · {addr or '—'} · {mode} · {status} · офферов: {cnt}")
         buttons.append([InlineKeyboardButton(f"Офферы по #{rid}", callback_data=f"view_offers:{rid}")])
-    await update.callback_query.message.reply_text("\n".join(lines), reply_markup=InlineKeyboardMarkup(buttons))
+    nav = page_nav("my", rows, has_older, has_newer)
+    if nav:
+        buttons.append(nav)
+    return "\n".join(lines), InlineKeyboardMarkup(buttons)
+
+async def cmd_my_inline(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = await get_or_create_user(update.effective_user, role="client")
+    page = await my_requests_page(uid)
+    if not page:
+        await update.callback_query.message.reply_text("Пока нет заявок.", reply_markup=inline_main_menu())
+        return
+    text, kb = page
+    await update.callback_query.message.reply_text(text, reply_markup=kb)
+
+async def on_my_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # my:older:<id> / my:newer:<id>, edits the list in place
+    q = update.callback_query
+    await q.answer()
+    _, direction, sid = q.data.split(":")
+    uid = await get_or_create_user(update.effective_user, role="client")
+    page = await my_requests_page(uid, int(sid), direction == "newer")
+    if not page:
+        await show_page(q, "Пока нет заявок.", inline_main_menu())
+        return
+    await show_page(q, *page)
 
 async def on_view_offers(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # view_offers:<req_id> opens the newest page, offers:<req_id>:older|newer:<id> pages; all in one message
     q = update.callback_query
     await q.answer()
-    _, sreq = q.data.split(":")
-    rid = int(sreq)
-    offs = await get_offers_by_request(rid)
+    parts = q.data.split(":")
+    rid = int(parts[1])
+    cursor, newer = (int(parts[3]), parts[2] == "newer") if len(parts) == 4 else (0, False)
+    async with DB.reader() as db:
+        offs, has_older, has_newer = await keyset_page(
+            db, "SELECT id, executor_id, rate_type, rate_value, comment, status, created_at FROM offers", "request_id=?",
+            (rid,), cursor, newer, OFFERS_PAGE_SIZE)
+    back = [InlineKeyboardButton("« К заявкам", callback_data="my:older:0")]
     if not offs:
-        await q.message.reply_text(f"По заявке #{rid} пока нет офферов.", reply_markup=inline_main_menu())
+        await show_page(q, f"По заявке #{rid} пока нет офферов.", InlineKeyboardMarkup([back]))
         return
-    for oid, exid, rt, rv, comment, status, created in offs[:20]:
-        kb = InlineKeyboardMarkup.from_button(InlineKeyboardButton("Принять оффер", callback_data=f"accept_offer:{oid}"))
-        await q.message.reply_text(
-            f"Оффер #{oid} · {created.split('T')[0]}\n"
+    lines = [f"Офферы по заявке #{rid}:"]
+    buttons = []
+    for oid, exid, rt, rv, comment, status, created in offs:
+        comment = comment or "—"
+        if len(comment) > 200:
+            comment = comment[:199] + "…"
+        lines.append(
+            f"\nОффер #{oid} · {created.split('T')[0]}\n"
             f"Исполнитель: E-{exid:05d}\n"
             f"Ставка: {rv} ({rt})\n"
-            f"Комментарий: {comment or '—'}\n"
-            f"Статус: {status}",
-            reply_markup=kb
+            f"Комментарий: {comment}\n"
+            f"Статус: {status}"
         )
+        buttons.append([InlineKeyboardButton(f"Принять оффер #{oid}", callback_data=f"accept_offer:{oid}")])
+    nav = page_nav(f"offers:{rid}", offs, has_older, has_newer)
+    if nav:
+        buttons.append(nav)
+    buttons.append(back)
+    await show_page(q, "\n".join(lines), InlineKeyboardMarkup(buttons))
 
 # --- Admin commands (unchanged API)
+EXEC_PAGE_SIZE = 15
+
+def parse_exec_filter(text: str) -> dict:
+    # city="Город" cat="Категория" --owner|--contract --on|--off
+    f = {}
+    m = re.search(r'city="([^"]+)"', text)
+    if m: f["city"] = m.group(1).strip()
+    m = re.search(r'cat="([^"]+)"', text)
+    if m: f["cat"] = m.group(1).strip()
+    flags = set(re.sub(r'"[^"]*"', "", text).split())
+    if "--owner" in flags: f["owner"] = True
+    elif "--contract" in flags: f["owner"] = False
+    if "--on" in flags: f["active"] = True
+    elif "--off" in flags: f["active"] = False
+    return f
+
+def exec_filter_text(f: dict) -> str:
+    parts = []
+    if f.get("city"): parts.append(f"город {f['city']}")
+    if f.get("cat"): parts.append(f"категория {f['cat']}")
+    if f.get("owner") is not None: parts.append("свои" if f["owner"] else "подряд")
+    if f.get("active") is not None: parts.append("ON" if f["active"] else "OFF")
+    return ", ".join(parts) or "все"
+
+async def exec_list_page(f: dict, cursor: int = 0, newer: bool = False) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    rows, has_older, has_newer = await admin_executors_page(f, cursor, newer, EXEC_PAGE_SIZE)
+    if not rows:
+        return f"Исполнителей нет ({exec_filter_text(f)}).", inline_main_menu()
+    lines = [f"Исполнители ({exec_filter_text(f)}):"]
+    for (eid, uid, pun, tgid, city, rad, cats, owner, active) in rows:
+        cats = cats or ""
+        if len(cats) > 60:
+            cats = cats[:59] + "…"
+        lines.append(f"E-{eid:05d} | @{pun or '-'} | tg_id={tgid or '-'} | user_id={uid or '-'} | {city or '-'} | {rad}км | [{cats}] | "
+                     f"{'СВОЙ' if owner else 'подряд'} | {'ON' if active else 'OFF'}")
+    nav = page_nav("xl", rows, has_older, has_newer)
+    return "\n".join(lines), InlineKeyboardMarkup([nav]) if nav else None
+
+async def on_exec_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # xl:older:<id> / xl:newer:<id> from /admin list_exec
+    q = update.callback_query
+    await q.answer()
+    if not is_admin(update.effective_user.id):
+        return
+    f = context.user_data.get("exec_filter")
+    if f is None:
+        await q.message.reply_text("Список устарел, повторите /admin list_exec.", reply_markup=inline_main_menu())
+        return
+    _, direction, sid = q.data.split(":")
+    await show_page(q, *await exec_list_page(f, int(sid), direction == "newer"))
+
 async def cmd_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         return
@@ -761,7 +2444,15 @@ async def cmd_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "/admin prefer_owner on|off\n"
             "/admin add_executor @username \"Город\" 50 \"кат1,кат2\" [--owner]\n"
             "/admin add_exec_id 123456789 \"Город\" 50 \"кат1,кат2\" [--owner]\n"
-            "/admin list_exec\n"
+            "/admin list_exec [city=\"Город\"] [cat=\"Категория\"] [--owner|--contract] [--on|--off]\n"
+            "/admin export_exec [те же фильтры] — выгрузка CSV\n"
+            "/admin reindex — сверить индекс подбора с БД и перестроить\n"
+            "/admin geocache — статистика кэша геокодера\n"
+            "/admin cache — статистика кэшей настроек и справочников\n"
+            "/admin mem — память user_data и активные диалоги\n"
+            "/admin stats — задержки обработчиков, БД, геокодера и Bot API\n"
+            "/admin outbox — очередь исходящих уведомлений\n"
+            "/admin fanout <request_id> — доставка приглашений по заявке\n"
             "/admin set_loc <exec_id> (ответьте геолокацией)\n"
             "/admin assign <request_id> <executor_id>",
             reply_markup=inline_main_menu()
@@ -811,15 +2502,47 @@ async def cmd_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text('Формат: /admin add_exec_id 123456789 "Город" 50 "кат1,кат2" [--owner]',
                                             reply_markup=inline_main_menu())
     elif sub == "list_exec":
-        rows = await admin_list_executors()
-        if not rows:
-            await update.message.reply_text("Исполнителей нет.", reply_markup=inline_main_menu())
-            return
-        lines = []
-        for (eid, uid, pun, tgid, city, rad, cats, owner, active) in rows:
-            lines.append(f"E-{eid:05d} | @{pun or '-'} | tg_id={tgid or '-'} | user_id={uid or '-'} | {city or '-'} | {rad}км | [{cats}] | "
-                         f"{'СВОЙ' if owner else 'подряд'} | {'ON' if active else 'OFF'}")
-        await update.message.reply_text("\n".join(lines)[:4000], reply_markup=inline_main_menu())
+        f = parse_exec_filter(update.message.text)
+        # the pager buttons only carry the cursor; the filter stays with the admin
+        context.user_data["exec_filter"] = f
+        text, kb = await exec_list_page(f)
+        await update.message.reply_text(text, reply_markup=kb)
+    elif sub == "export_exec":
+        f = parse_exec_filter(update.message.text)
+        # spooled to a temp file so a large table is not built up in memory
+        with tempfile.TemporaryFile() as tmp:
+            with io.TextIOWrapper(tmp, encoding="utf-8-sig", newline="") as out:
+                n = await admin_export_executors(f, out)
+                out.flush()
+                tmp.seek(0)
+                await update.message.reply_document(
+                    tmp, filename=f"executors-{datetime.utcnow():%Y%m%d-%H%M}.csv",
+                    caption=f"Исполнители ({exec_filter_text(f)}): {n}")
+    elif sub == "reindex":
+        diff = await MATCHER.check(repair=True)
+        await update.message.reply_text(f"Индекс подбора: {len(MATCHER.recs)} исполнителей, расхождений с БД: {diff}"
+                                        + (" (перестроен)" if diff else ""), reply_markup=inline_main_menu())
+    elif sub == "cache":
+        text = "\n".join([c.summary() for c in REF_CACHES] + [PERSISTENCE.summary()])
+        await update.message.reply_text(text, reply_markup=inline_main_menu())
+    elif sub == "stats":
+        await update.message.reply_text(METRICS.summary(), reply_markup=inline_main_menu())
+    elif sub == "outbox":
+        await update.message.reply_text(await OUTBOX.summary(), reply_markup=inline_main_menu())
+    elif sub == "fanout" and len(args)>=2:
+        rid = int(args[1])
+        r = await OUTBOX.report(rid)
+        if not any(r.values()):
+            text = f"По заявке #{rid} приглашений нет (или они уже удалены из очереди)."
+        else:
+            text = (f"Приглашения по заявке #{rid}: всего {sum(r.values())}\n"
+                    f"отправлено {r['sent']}, заблокировали бота {r['blocked']}, отклонено {r['failed']}\n"
+                    f"повтор после ошибки {r['retry']}, ещё не отправлено {r['pending']}")
+        await update.message.reply_text(text, reply_markup=inline_main_menu())
+    elif sub == "mem":
+        await update.message.reply_text(SWEEPER.memory_report(context.application), reply_markup=inline_main_menu())
+    elif sub == "geocache":
+        await update.message.reply_text(GEOCACHE.summary(), reply_markup=inline_main_menu())
     elif sub == "set_loc" and len(args)>=2:
         context.user_data["await_loc_for_exec"] = int(args[1])
         await update.message.reply_text("Окей. Отправьте геолокацию сообщением-ответом.")
@@ -868,31 +2591,146 @@ async def on_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 # ===== App build & error handling =====
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    # Up to max_concurrent_updates updates run at once, but updates of the same user (or chat,
+    # for updates without a user) run one after another in arrival order, so ConversationHandler
+    # state transitions never interleave. A waiting update does not occupy a worker slot.
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._locks: dict = {}  # key -> [asyncio.Lock, number of updates holding/waiting]
+
+    @staticmethod
+    def _key(update: object):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return "u", update.effective_user.id
+            if update.effective_chat:
+                return "c", update.effective_chat.id
+        return None
+
+    async def process_update(self, update: object, coroutine) -> None:
+        # the trace set here is seen by everything the update awaits; it is reset afterwards so
+        # nothing that copies this context later appends to a finished trace
+        tr = Trace(update) if isinstance(update, Update) else None
+        token = CURRENT_TRACE.set(tr) if tr is not None else None
+        try:
+            await self._process_in_order(update, coroutine)
+        finally:
+            if tr is not None:
+                TRACER.finish(tr)
+                CURRENT_TRACE.reset(token)
+
+    async def _process_in_order(self, update: object, coroutine) -> None:
+        key = self._key(update)
+        if key is None:
+            await super().process_update(update, coroutine)
+            return
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        tr = CURRENT_TRACE.get()
+        if tr is not None:
+            tr.queued = time.perf_counter() - tr.t0
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+METRICS_RUNNER: Optional[web.AppRunner] = None
+
 async def _post_init(app):
+    global METRICS_RUNNER
+    http_session()
+    TRACER.open()
+    try:
+        METRICS_RUNNER = await start_metrics_server()
+    except OSError as e:
+        logging.warning("metrics listener on %s:%s failed: %s", METRICS_LISTEN, METRICS_PORT, e)
+    SWEEPER.start(app)
+    OUTBOX.start(app.bot)
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            logging.warning("WEBHOOK_URL is not set; serving %s without registering the webhook", WEBHOOK_PATH)
+            return
+        await app.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=True,
+        )
+        return
     try:
         await app.bot.delete_webhook(drop_pending_updates=True)
     except Exception as e:
         logging.warning("delete_webhook failed: %s", e)
 
+async def _post_stop(app):
+    # the bot is shut down before post_shutdown, so the outbox batch in flight is finished here
+    await OUTBOX.stop()
+
+async def _post_shutdown(app):
+    global METRICS_RUNNER
+    if METRICS_RUNNER is not None:
+        await METRICS_RUNNER.cleanup()
+        METRICS_RUNNER = None
+    await SWEEPER.stop()
+    TRACER.close()
+    await http_close()
+    await db_close()
+
 async def error_handler(update, context):
-    logging.exception("Exception while handling an update:", exc_info=context.error)
+    tr = CURRENT_TRACE.get()
+    logging.exception("Exception while handling an update (trace %s):", tr.trace_id if tr else "-",
+                      exc_info=context.error)
+
+def _conversation(**kwargs):
+    # Conversations are keyed per chat and user: every step's buttons sit on a new message and
+    # text steps have no callback message at all, so per_message keys would never match.
+    # PTB warns about that choice on construction; silence it here only.
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", message=r".*'CallbackQueryHandler'", category=PTBUserWarning)
+        return ConversationHandler(**kwargs)
+
 
 def build_app():
-    app = ApplicationBuilder().token(BOT_TOKEN).post_init(_post_init).build()
+    app = (
+        ApplicationBuilder().token(BOT_TOKEN).request(InstrumentedRequest(connection_pool_size=256))
+        .base_url(TELEGRAM_API_URL + "/bot").base_file_url(TELEGRAM_API_URL + "/file/bot")
+        .concurrent_updates(PerUserUpdateProcessor(UPDATE_CONCURRENCY))
+        .persistence(PERSISTENCE)
+        .post_init(_post_init).post_stop(_post_stop).post_shutdown(_post_shutdown)
+        .build()
+    )
     app.add_error_handler(error_handler)
+    app.add_handler(TypeHandler(Update, SWEEPER.touch), group=-1)
 
     # Start & role selection (inline)
-    start_conv = ConversationHandler(
+    start_conv = _conversation(
         entry_points=[CommandHandler("start", start)],
         states={
             ROLE_SEL: [CallbackQueryHandler(on_role, pattern=r"^role:(client|executor|admin)$")]
         },
         fallbacks=[CallbackQueryHandler(on_cancel, pattern=r"^cancel$")],
-        per_message=True
+        per_message=False,
+        name="start_conv", persistent=True
     )
 
     # New request flow
-    req_conv = ConversationHandler(
+    req_conv = _conversation(
         entry_points=[
             CallbackQueryHandler(on_imenu, pattern=r"^imenu:new$"),
             CallbackQueryHandler(on_imenu, pattern=r"^imenu:catalog$"),
@@ -909,11 +2747,12 @@ def build_app():
             RAD_IN: [MessageHandler(filters.TEXT & ~filters.COMMAND, radius_input)],
         },
         fallbacks=[CallbackQueryHandler(on_cancel, pattern=r"^cancel$")],
-        per_message=True
+        per_message=False,
+        name="req_conv", persistent=True
     )
 
     # Offer flow (executor)
-    offer_conv = ConversationHandler(
+    offer_conv = _conversation(
         entry_points=[CallbackQueryHandler(on_offer_click, pattern=r"^offer:\d+:\d+$")],
         states={
             OFFER_RATE_TYPE: [CallbackQueryHandler(on_rate_type, pattern=r"^rt:(час|смена|объект)$"),
@@ -922,7 +2761,8 @@ def build_app():
             OFFER_COMMENT: [MessageHandler(filters.TEXT & ~filters.COMMAND, on_offer_comment)],
         },
         fallbacks=[CallbackQueryHandler(on_cancel, pattern=r"^cancel$")],
-        per_message=True
+        per_message=False,
+        name="offer_conv", persistent=True
     )
 
     # Global inline routes
@@ -932,14 +2772,76 @@ def build_app():
     app.add_handler(CallbackQueryHandler(on_request_offer, pattern=r"^req_offer:\d+:\d+$"))
     app.add_handler(CallbackQueryHandler(on_accept_offer, pattern=r"^accept_offer:\d+$"))
     app.add_handler(CallbackQueryHandler(on_imenu, pattern=r"^imenu:(home|my|help)$"))
-    app.add_handler(CallbackQueryHandler(on_view_offers, pattern=r"^view_offers:\d+$"))
+    app.add_handler(CallbackQueryHandler(on_view_offers, pattern=r"^(view_offers:\d+|offers:\d+:(older|newer):\d+)$"))
+    app.add_handler(CallbackQueryHandler(on_my_page, pattern=r"^my:(older|newer):\d+$"))
+    app.add_handler(CallbackQueryHandler(on_exec_page, pattern=r"^xl:(older|newer):\d+$"))
 
     # Admin & misc
     app.add_handler(CommandHandler("admin", cmd_admin))
     app.add_handler(MessageHandler(filters.LOCATION & filters.REPLY, on_location_reply))
 
+    instrument_handlers(app)
     return app
 
+# ===== Webhook mode =====
+def make_webhook_app(application) -> web.Application:
+    # POST WEBHOOK_PATH: Telegram updates (secret-token checked) -> application.update_queue
+    # GET /healthz: liveness plus the update queue depth
+    started = time.monotonic()
+
+    async def on_update(request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and not hmac.compare_digest(
+                request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), WEBHOOK_SECRET):
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(await request.json(), application.bot)
+        except Exception:
+            return web.Response(status=400)
+        await application.update_queue.put(update)
+        return web.Response()
+
+    async def on_health(request: web.Request) -> web.Response:
+        return web.json_response({
+            "ok": True,
+            "mode": "webhook",
+            "uptime_s": round(time.monotonic() - started, 1),
+            "update_queue": application.update_queue.qsize(),
+        })
+
+    webapp = web.Application(client_max_size=1 << 20)
+    webapp.router.add_post(WEBHOOK_PATH, on_update)
+    webapp.router.add_get("/healthz", on_health)
+    return webapp
+
+async def run_webhook(application):
+    # the run_polling() lifecycle, with the aiohttp server in place of the updater
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    runner = web.AppRunner(make_webhook_app(application), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT, backlog=max(128, WEBHOOK_MAX_CONNECTIONS)).start()
+    logging.info("webhook server on %s:%s%s", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH)
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        if application.running:
+            await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
 if __name__ == "__main__":
     if not BOT_TOKEN:
         raise SystemExit("Set BOT_TOKEN in environment (BOT_TOKEN)")
@@ -947,5 +2849,9 @@ if __name__ == "__main__":
     asyncio.set_event_loop(loop)
     loop.run_until_complete(db_init())
     application = build_app()
-    print("Bot is running (polling). Press Ctrl+C to stop.")
-    application.run_polling(drop_pending_updates=True)
+    if BOT_MODE == "webhook":
+        print(f"Bot is running (webhook on :{WEBHOOK_PORT}{WEBHOOK_PATH}). Press Ctrl+C to stop.")
+        loop.run_until_complete(run_webhook(application))
+    else:
+        print("Bot is running (polling). Press Ctrl+C to stop.")
+        application.run_polling(drop_pending_updates=True)
@@ -0,0 +1,36 @@
+# Shared fixtures. The bot's helpers are async and pytest-asyncio is not required: each test
+# runs its scenario with asyncio.run() against a fresh broker.db in tmp_path.
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import broker_bot as bb  # noqa: E402
+
+
+@pytest.fixture
+def bot_db(tmp_path, monkeypatch):
+    # module-level singletons hold asyncio primitives, so every test gets its own
+    monkeypatch.setattr(bb, "DB_PATH", str(tmp_path / "broker.db"))
+    monkeypatch.setattr(bb, "DB", None)
+    monkeypatch.setattr(bb, "BROADCASTER", bb.Broadcaster(rate=1000, per_chat_rate=1000, concurrency=16))
+    monkeypatch.setattr(bb, "OUTBOX", bb.Outbox(batch=50, max_attempts=3, keep_days=7))
+    monkeypatch.setattr(bb.TRACER, "path", "")
+    for cache in bb.REF_CACHES:
+        cache.invalidate()
+    return bb
+
+
+@pytest.fixture
+def bot_app(bot_db, monkeypatch):
+    # build_app() wired to an in-process Bot API; returns the stub so tests can read the calls
+    from helpers import StubBotAPI
+    stub = StubBotAPI()
+    monkeypatch.setattr(bb, "BOT_TOKEN", "123456:TEST")
+    monkeypatch.setattr(bb, "METRICS_PORT", 0)
+    monkeypatch.setattr(bb, "InstrumentedRequest", lambda **kw: stub)
+    monkeypatch.setattr(bb, "PERSISTENCE", bb.SQLitePersistence(update_interval=60))
+    monkeypatch.setattr(bb, "SWEEPER", bb.SessionSweeper(timeout=600, interval=3600))
+    return stub
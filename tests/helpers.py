@@ -0,0 +1,132 @@
+# Fakes and seed data shared by the tests. Kept apart from benchmarks/ so a change to a
+# benchmark script cannot break the suite.
+import asyncio
+import itertools
+import json
+import time
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+import broker_bot as bb
+
+BOT_USER = {"id": 4242, "is_bot": True, "first_name": "Broker", "username": "broker_test_bot"}
+
+
+class FakeMessage:
+    async def reply_text(self, *a, **kw):
+        return self
+
+    async def edit_text(self, *a, **kw):
+        return self
+
+
+class RecordingBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, reply_markup=None, **kw):
+        self.sent.append((chat_id, text))
+
+
+def fake_callback(tg_user, data):
+    q = SimpleNamespace(data=data, message=FakeMessage(), answer=lambda *a, **kw: asyncio.sleep(0))
+    update = SimpleNamespace(effective_user=tg_user, callback_query=q, message=None,
+                             effective_chat=SimpleNamespace(id=tg_user.id))
+    context = SimpleNamespace(bot=RecordingBot(), user_data={}, args=[],
+                              application=SimpleNamespace(create_task=lambda coro, **kw: asyncio.ensure_future(coro)))
+    return update, context
+
+
+async def seed():
+    # a client with one auction request, an executor per category (direct_tg_id 8000 + i,
+    # pending username exec<i>) and one offer from executor 0
+    client = SimpleNamespace(id=9001, username="test_client", first_name="T", last_name=None)
+    uid = await bb.get_or_create_user(client, role="client")
+    execs = []
+    for i, cat in enumerate(bb.CATEGORY_CHOICES):
+        eid = await bb.admin_add_executor(f"exec{i}", "Москва", 100, [cat, bb.CATEGORY_CHOICES[0]], i % 2 == 0,
+                                          direct_tg_id=8000 + i)
+        await bb.set_executor_location(eid, 55.7 + i / 100, 37.6)
+        execs.append(eid)
+    req_id = await bb.new_request(uid, bb.CATEGORY_CHOICES[0], "d", "a", "", 55.75, 37.6, 200, "auction")
+    offer_id = await bb.create_offer_notify(req_id, execs[0], "час", 10, "")
+    return client, uid, execs, req_id, offer_id
+
+
+class StubBotAPI(BaseRequest):
+    # answers Bot API calls in-process and records them as (method, parameters)
+    def __init__(self):
+        self.calls = []
+        self._ids = itertools.count(1000)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def sent(self, chat_id=None) -> list:
+        # texts of sendMessage calls, optionally to one chat
+        return [p["text"] for m, p in self.calls
+                if m == "sendMessage" and (chat_id is None or int(p["chat_id"]) == chat_id)]
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        name = url.rsplit("/", 1)[1]
+        params = request_data.parameters if request_data else {}
+        self.calls.append((name, params))
+        if name == "getMe":
+            result = BOT_USER
+        elif name in ("sendMessage", "editMessageText"):
+            mid = params["message_id"] if name == "editMessageText" else next(self._ids)
+            result = {"message_id": mid, "date": int(time.time()), "from": BOT_USER, "text": params.get("text", ""),
+                      "chat": {"id": int(params["chat_id"]), "type": "private"}}
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def _user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": "u", "username": f"user{user_id}"}
+
+
+def message_update(bot, update_id: int, user_id: int, text: str) -> Update:
+    return Update.de_json({
+        "update_id": update_id,
+        "message": {"message_id": update_id, "date": 0, "text": text, "from": _user(user_id),
+                    "chat": {"id": user_id, "type": "private"},
+                    **({"entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]}
+                       if text.startswith("/") else {})},
+    }, bot)
+
+
+def callback_update(bot, update_id: int, user_id: int, data: str) -> Update:
+    # a button tap on a bot message in the user's private chat
+    return Update.de_json({
+        "update_id": update_id,
+        "callback_query": {"id": str(update_id), "chat_instance": "c", "data": data, "from": _user(user_id),
+                           "message": {"message_id": 1, "date": 0, "text": "menu", "from": BOT_USER,
+                                       "chat": {"id": user_id, "type": "private"}}},
+    }, bot)
+
+
+@asynccontextmanager
+async def running(application):
+    # the run_polling() lifecycle without the updater; updates go in through update_queue
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    try:
+        yield application
+    finally:
+        await application.stop()
+        await application.post_stop(application)
+        await application.shutdown()
+        await application.post_shutdown(application)
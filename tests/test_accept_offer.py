@@ -0,0 +1,59 @@
+import asyncio
+from types import SimpleNamespace
+
+from helpers import RecordingBot, fake_callback, seed
+
+
+def test_parallel_accept_taps_make_one_deal_and_one_notice(bot_db):
+    bb = bot_db
+
+    async def scenario():
+        await bb.db_init()
+        try:
+            client, uid, execs, req_id, offer_id = await seed()
+            # executor 0 has direct_tg_id 8000; linking it gives the deal a contact and a chat
+            await bb.get_or_create_user(SimpleNamespace(id=8000, username="exec0", first_name=None, last_name=None))
+            replies = []
+
+            async def tap():
+                update, context = fake_callback(client, f"accept_offer:{offer_id}")
+
+                async def reply_text(text, **kw):
+                    replies.append(text)
+                update.callback_query.message.reply_text = reply_text
+                await bb.on_accept_offer(update, context)
+
+            await asyncio.gather(*(tap() for _ in range(50)))
+
+            deals = await bb.DB.fetchall("SELECT contacts_released FROM deals WHERE offer_id=?", (offer_id,))
+            assert deals == [(1,)]
+            assert await bb.DB.fetchone("SELECT status FROM offers WHERE id=?", (offer_id,)) == ("accepted",)
+            assert len(replies) == 50
+            assert sum(r.startswith("Оффер принят") for r in replies) == 1
+            assert all("@exec0" in r for r in replies)
+            # besides the client's offer notice queued by seed()
+            notices = await bb.DB.fetchall("SELECT chat_id, kind FROM outbox WHERE kind!='offer'")
+            assert notices == [(8000, "accepted")]
+
+            bot = RecordingBot()
+            assert await bb.OUTBOX.drain_once(bot) == 1
+            assert [chat for chat, _ in bot.sent] == [8000]
+            assert await bb.OUTBOX.drain_once(bot) == 0
+        finally:
+            await bb.db_close()
+
+    asyncio.run(scenario())
+
+
+def test_accepting_a_missing_offer_returns_none(bot_db):
+    bb = bot_db
+
+    async def scenario():
+        await bb.db_init()
+        try:
+            assert await bb.accept_offer(999) is None
+            assert await bb.DB.fetchone("SELECT COUNT(*) FROM deals") == (0,)
+        finally:
+            await bb.db_close()
+
+    asyncio.run(scenario())
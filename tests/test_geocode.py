@@ -0,0 +1,106 @@
+import asyncio
+import time
+
+import pytest
+from aiohttp import web
+
+import broker_bot as bb
+
+RPS = 5.0
+
+
+class StubGeocoder:
+    # stand-in for Nominatim that records when each request arrived
+    def __init__(self, delay: float = 0.2):
+        self.delay = delay
+        self.calls = []  # (monotonic time, q)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        q = request.query["q"]
+        self.calls.append((time.monotonic(), q))
+        await asyncio.sleep(self.delay)
+        return web.json_response([{"display_name": f"{q}, Россия", "lat": "55.75", "lon": "37.61"}])
+
+    async def start(self) -> web.AppRunner:
+        app = web.Application()
+        app.router.add_get("/search", self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        bb.GEOCODE_URL = "http://127.0.0.1:%d/search" % runner.addresses[0][1]
+        return runner
+
+
+@pytest.fixture
+def geo(bot_db, monkeypatch):
+    # restored after the test; the stub and run() below replace them
+    monkeypatch.setattr(bb, "GEOCODE_URL", bb.GEOCODE_URL)
+    monkeypatch.setattr(bb, "GEOCODE_LIMITER", bb.GEOCODE_LIMITER)
+    monkeypatch.setattr(bb, "GEOCODE_INFLIGHT", {})
+    monkeypatch.setattr(bb, "GEOCACHE", bb.GeocodeCache(lru_size=64, ttl_s=3600, max_rows=100))
+    monkeypatch.setattr(bb, "HTTP", None)
+    stub = StubGeocoder()
+
+    def run(scenario):
+        async def wrapped():
+            # the limiter's lock belongs to the running loop
+            bb.GEOCODE_LIMITER = bb.TokenBucket(rate=RPS)
+            runner = await stub.start()
+            await bb.db_init()
+            try:
+                return await scenario()
+            finally:
+                await bb.db_close()
+                await bb.http_close()
+                await runner.cleanup()
+        return asyncio.run(wrapped())
+
+    return stub, run
+
+
+def test_concurrent_identical_lookups_make_one_upstream_call(geo):
+    stub, run = geo
+    spellings = ["Москва, Тверская 1", "москва ,  тверская 1", " МОСКВА,Тверская 1. "]
+
+    async def scenario():
+        return await asyncio.gather(*(bb.geocode_address(spellings[i % 3]) for i in range(20)))
+
+    results = run(scenario)
+    assert len(stub.calls) == 1
+    assert all(r == results[0] and r for r in results)
+    s = bb.GEOCACHE.stats
+    assert (s["misses"], s["coalesced"], s["upstream_calls"]) == (1, 19, 1)
+    assert bb.GEOCODE_INFLIGHT == {}
+
+
+def test_distinct_lookups_are_spaced_by_the_limiter(geo):
+    stub, run = geo
+
+    async def scenario():
+        await asyncio.gather(*(bb.geocode_address(f"Казань, Баумана {n}") for n in range(4)))
+
+    run(scenario)
+    assert len(stub.calls) == 4
+    times = sorted(t for t, _ in stub.calls)
+    gaps = [b - a for a, b in zip(times, times[1:])]
+    assert min(gaps) >= 1 / RPS * 0.9, gaps
+
+
+def test_cancelled_waiter_does_not_cancel_the_shared_lookup(geo):
+    stub, run = geo
+
+    async def scenario():
+        waiters = [asyncio.create_task(bb.geocode_address("Самара, Ленина 5")) for _ in range(3)]
+        await asyncio.sleep(0.05)  # the upstream request is in flight
+        waiters[0].cancel()
+        done = await asyncio.gather(*waiters, return_exceptions=True)
+        # a later lookup is served from the cache the shared call filled
+        again = await bb.geocode_address("самара, ленина 5")
+        return done, again
+
+    (first, second, third), again = run(scenario)
+    assert isinstance(first, asyncio.CancelledError)
+    assert second == third and second and second[0]["lat"] == 55.75
+    assert again == second
+    assert len(stub.calls) == 1
@@ -0,0 +1,87 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+
+class FlakyBot:
+    def __init__(self):
+        self.fail = True
+        self.sent = []
+
+    async def send_message(self, chat_id, text, reply_markup=None, **kw):
+        if self.fail:
+            raise TimedOut()
+        self.sent.append((chat_id, text))
+
+
+def test_offer_in_backoff_does_not_hold_back_the_next_window(bot_db):
+    bb = bot_db
+    bb.BROADCASTER.attempts = 1
+
+    async def scenario():
+        await bb.db_init()
+        try:
+            async with bb.DB.transaction() as db:
+                await bb.OUTBOX.put_offer(db, 500, 1, "offer 1", None, window=0)
+            bot = FlakyBot()
+            assert await bb.OUTBOX.drain_once(bot) == 1
+            attempts, retry_at = await bb.DB.fetchone("SELECT attempts, next_at FROM outbox WHERE ref_id=1")
+            assert attempts == 1 and retry_at > time.time() + 3
+
+            # the next offer opens its own window instead of joining the retried row's
+            async with bb.DB.transaction() as db:
+                await bb.OUTBOX.put_offer(db, 500, 2, "offer 2", None, window=0.2)
+            due = (await bb.DB.fetchone("SELECT next_at FROM outbox WHERE ref_id=2"))[0]
+            assert due < time.time() + 0.3
+
+            bot.fail = False
+            await asyncio.sleep(0.3)
+            assert await bb.OUTBOX.drain_once(bot) == 1
+            assert bot.sent == [(500, "offer 2")]
+            assert await bb.DB.fetchone("SELECT status FROM outbox WHERE ref_id=1") == ("pending",)
+        finally:
+            await bb.db_close()
+
+    asyncio.run(scenario())
+
+
+class PerChatBot:
+    # fails every send to a chat with that chat's error, if it has one
+    def __init__(self, errors):
+        self.errors = errors
+        self.sent = []
+
+    async def send_message(self, chat_id, text, reply_markup=None, **kw):
+        if chat_id in self.errors:
+            raise self.errors[chat_id]
+        self.sent.append(chat_id)
+
+
+def test_fanout_report_counts_each_outcome(bot_db):
+    bb = bot_db
+    bb.BROADCASTER.attempts = 1
+
+    async def scenario():
+        await bb.db_init()
+        try:
+            client = await bb.get_or_create_user(SimpleNamespace(id=600, username=None, first_name=None, last_name=None))
+            # find_matches() rows: (exec_id, user_id, pending_username, direct_tg_id, km, is_owner, city, chat_id)
+            candidates = [(i, None, None, chat, 1.0, 0, "Москва", chat) for i, chat in enumerate((701, 702, 703, 704, 705), 1)]
+            req_id, queued = await bb.create_auction_request(client, "Экскаватор", "d", "a", 55.75, 37.6, 10, candidates)
+            other_req, _ = await bb.create_auction_request(client, "Экскаватор", "d", "a", 55.75, 37.6, 10, candidates[:1])
+            assert queued == 5
+            assert (await bb.OUTBOX.report(req_id))["pending"] == 5
+
+            bot = PerChatBot({702: Forbidden("blocked"), 703: BadRequest("chat not found"),
+                              704: RetryAfter(0), 705: NetworkError("reset")})
+            while await bb.OUTBOX.drain_once(bot):
+                pass
+            assert sorted(bot.sent) == [701, 701]
+            assert await bb.OUTBOX.report(req_id) == {"sent": 1, "failed": 1, "blocked": 1, "retry": 2, "pending": 0}
+            assert await bb.OUTBOX.report(other_req) == {"sent": 1, "failed": 0, "blocked": 0, "retry": 0, "pending": 0}
+        finally:
+            await bb.db_close()
+
+    asyncio.run(scenario())
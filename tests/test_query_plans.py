@@ -0,0 +1,9 @@
+import asyncio
+
+from benchmarks import check_plans
+
+
+def test_hot_queries_use_indexes(bot_db, capsys):
+    # fails if any statement on the bot's per-update paths plans a full table SCAN
+    failures = asyncio.run(check_plans.audit())
+    assert failures == 0, capsys.readouterr().out
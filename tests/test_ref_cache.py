@@ -0,0 +1,45 @@
+import asyncio
+from types import SimpleNamespace
+
+
+def test_executor_cache_is_invalidated_by_every_writer(bot_db):
+    bb = bot_db
+
+    async def scenario():
+        await bb.db_init()
+        try:
+            eid = await bb.admin_add_executor("cached_exec", "Москва", 50, ["Экскаватор"], False, direct_tg_id=7100)
+            hits, misses = bb.EXECUTORS.hits, bb.EXECUTORS.misses
+            row = await bb.get_executor(eid)
+            assert await bb.get_executor(eid) is row
+            assert (bb.EXECUTORS.hits - hits, bb.EXECUTORS.misses - misses) == (1, 1)
+
+            await bb.set_executor_location(eid, 55.75, 37.61)
+            assert (await bb.get_executor(eid))[6:8] == (55.75, 37.61)
+            await bb.set_executor_active(eid, False)
+            assert (await bb.get_executor(eid))[10] == 0
+
+            # the executor starts the bot: linked by username, chat id now from the user
+            uid = await bb.get_or_create_user(SimpleNamespace(id=7200, username="cached_exec", first_name=None,
+                                                              last_name=None))
+            row = await bb.get_executor(eid)
+            assert (row[1], row[2], row[11]) == (uid, None, 7200)
+            assert "executors:" in "\n".join(c.summary() for c in bb.REF_CACHES)
+        finally:
+            await bb.db_close()
+
+    asyncio.run(scenario())
+
+
+def test_load_racing_an_invalidation_is_not_cached():
+    from broker_bot import RefCache
+    cache = RefCache("t")
+
+    async def scenario():
+        async def stale_load():
+            cache.invalidate("k")  # a writer commits while the read is in flight
+            return "old"
+        assert await cache.get_or_load("k", stale_load) == "old"
+        assert cache.get("k") is None
+
+    asyncio.run(scenario())
@@ -0,0 +1,28 @@
+import asyncio
+import time
+
+import broker_bot as bb
+from helpers import running
+
+
+def test_restored_conversation_is_swept_after_the_timeout(bot_app):
+    async def scenario():
+        await bb.db_init()
+        # a user stuck in the description step before a restart, who never writes again
+        await bb.DB.execute("INSERT INTO bot_conversations(name, key, state, updated_at) VALUES(?,?,?,?)",
+                            ("req_conv", "[700, 700]", str(bb.DESC_IN), ""))
+        app = bb.build_app()
+        async with running(app):
+            conv = next(h for hs in app.handlers.values() for h in hs if getattr(h, "name", None) == "req_conv")
+            assert dict(conv._conversations) == {(700, 700): bb.DESC_IN}
+            assert 700 in bb.SWEEPER.last_seen
+
+            assert bb.SWEEPER.sweep(app, time.monotonic() + 1) == (0, 0)
+            assert bb.SWEEPER.sweep(app, time.monotonic() + bb.SWEEPER.timeout + 1) == (1, 1)
+            assert dict(conv._conversations) == {}
+
+            await app.update_persistence()
+            await bb.PERSISTENCE.flush()
+            assert await bb.DB.fetchall("SELECT name, key FROM bot_conversations") == []
+
+    asyncio.run(scenario())
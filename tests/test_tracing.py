@@ -0,0 +1,33 @@
+import asyncio
+
+from telegram import Update
+
+import broker_bot as bb
+
+
+def test_trace_does_not_outlive_its_update(monkeypatch):
+    monkeypatch.setattr(bb.TRACER, "path", "")
+    seen = {}
+
+    @bb.observe("db", "probe")
+    async def probe():
+        return bb.CURRENT_TRACE.get()
+
+    async def handler():
+        seen["inside"] = await probe()
+
+    async def scenario():
+        update = Update.de_json({
+            "update_id": 1,
+            "message": {"message_id": 1, "date": 0, "text": "hi", "chat": {"id": 5, "type": "private"},
+                        "from": {"id": 5, "is_bot": False, "first_name": "u"}},
+        }, None)
+        await bb.PerUserUpdateProcessor(4).process_update(update, handler())
+        # work started from this context afterwards must not see the finished trace
+        seen["after"] = await asyncio.create_task(probe())
+
+    asyncio.run(scenario())
+    tr = seen["inside"]
+    assert tr is not None and tr.done
+    assert [sp[1] for sp in tr.spans] == ["probe"]
+    assert seen["after"] is None
@@ -0,0 +1,91 @@
+import asyncio
+
+from telegram import Update
+from telegram.ext import TypeHandler
+
+import broker_bot as bb
+from helpers import callback_update, message_update, running
+
+
+def test_slow_user_does_not_block_others_and_keeps_own_order(monkeypatch):
+    monkeypatch.setattr(bb.TRACER, "path", "")
+    done = []
+
+    async def handler(name: str, delay: float):
+        await asyncio.sleep(delay)
+        done.append(name)
+
+    async def scenario():
+        proc = bb.PerUserUpdateProcessor(8)
+        jobs = [
+            (message_update(None, 1, 100, "a1"), handler("a1", 0.3)),  # slow update of user A
+            (message_update(None, 2, 100, "a2"), handler("a2", 0.0)),  # must wait for a1
+            (message_update(None, 3, 200, "b1"), handler("b1", 0.01)),
+            (message_update(None, 4, 300, "c1"), handler("c1", 0.01)),
+        ]
+        tasks = []
+        for update, coro in jobs:
+            tasks.append(asyncio.create_task(proc.process_update(update, coro)))
+            await asyncio.sleep(0)  # arrival order
+        await asyncio.wait_for(asyncio.gather(*tasks), 5)
+        return proc
+
+    proc = asyncio.run(scenario())
+    # B and C finish while A's slow update is still running; A's updates stay in order
+    assert set(done[:2]) == {"b1", "c1"}
+    assert done[2:] == ["a1", "a2"]
+    assert proc._locks == {}
+
+
+def test_concurrency_limit_still_applies(monkeypatch):
+    monkeypatch.setattr(bb.TRACER, "path", "")
+    running = peak = 0
+
+    async def handler():
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.02)
+        running -= 1
+
+    async def scenario():
+        proc = bb.PerUserUpdateProcessor(3)
+        await asyncio.gather(*(proc.process_update(message_update(None, i, 1000 + i, "x"), handler()) for i in range(10)))
+
+    asyncio.run(scenario())
+    assert peak == 3
+
+
+def test_app_serves_other_users_during_a_slow_update_and_keeps_conversation_order(bot_app):
+    stub = bot_app
+    a, b = 100, 200
+
+    async def slow_first_update(update, context):
+        if update.update_id == 1:
+            await asyncio.sleep(0.3)
+
+    async def scenario():
+        await bb.db_init()
+        app = bb.build_app()
+        app.add_handler(TypeHandler(Update, slow_first_update), group=-2)
+        async with running(app):
+            # A taps through the new request flow without waiting for replies; B starts meanwhile
+            for update in (callback_update(app.bot, 1, a, "imenu:new"),
+                           callback_update(app.bot, 2, a, "mode:auction"),
+                           callback_update(app.bot, 3, a, "cat:0"),
+                           message_update(app.bot, 4, a, "нужен экскаватор"),
+                           message_update(app.bot, 5, b, "/start")):
+                await app.update_queue.put(update)
+            for _ in range(200):
+                if len(stub.sent(a)) == 4 and stub.sent(b):
+                    break
+                await asyncio.sleep(0.01)
+            conv = next(h for hs in app.handlers.values() for h in hs if getattr(h, "name", None) == "req_conv")
+            return dict(conv._conversations), dict(app.user_data.get(a, {}))
+
+    states, user_data = asyncio.run(scenario())
+    chats = [int(p["chat_id"]) for m, p in stub.calls if m == "sendMessage"]
+    assert chats[0] == b
+    assert [t.split()[0] for t in stub.sent(a)] == ["Выберите", "Категория:", "Коротко", "Укажите"]
+    assert states == {(a, a): bb.ADDR_IN}
+    assert user_data == {"req_mode": "auction", "req_cat": bb.CATEGORY_CHOICES[0], "req_desc": "нужен экскаватор"}
@@ -0,0 +1,70 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+from aiohttp.test_utils import TestClient, TestServer
+from telegram import Update
+
+import broker_bot as bb
+
+SECRET = "s3cret"
+UPDATE = {
+    "update_id": 42,
+    "message": {"message_id": 7, "date": 0, "text": "/start", "chat": {"id": 5, "type": "private"},
+                "from": {"id": 5, "is_bot": False, "first_name": "u"}},
+}
+
+
+def run_client(monkeypatch, scenario):
+    monkeypatch.setattr(bb, "WEBHOOK_SECRET", SECRET)
+
+    async def wrapped():
+        application = SimpleNamespace(bot=None, update_queue=asyncio.Queue())
+        async with TestClient(TestServer(bb.make_webhook_app(application))) as client:
+            await scenario(client, application.update_queue)
+
+    asyncio.run(wrapped())
+
+
+def test_secret_token_is_required(monkeypatch):
+    async def scenario(client, queue):
+        r = await client.post(bb.WEBHOOK_PATH, json=UPDATE)
+        assert r.status == 403
+        r = await client.post(bb.WEBHOOK_PATH, json=UPDATE, headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+        assert r.status == 403
+        assert queue.empty()
+
+    run_client(monkeypatch, scenario)
+
+
+def test_malformed_body_is_rejected(monkeypatch):
+    async def scenario(client, queue):
+        r = await client.post(bb.WEBHOOK_PATH, data="{not json",
+                              headers={"X-Telegram-Bot-Api-Secret-Token": SECRET, "Content-Type": "application/json"})
+        assert r.status == 400
+        assert queue.empty()
+
+    run_client(monkeypatch, scenario)
+
+
+def test_update_is_queued(monkeypatch):
+    async def scenario(client, queue):
+        r = await client.post(bb.WEBHOOK_PATH, data=json.dumps(UPDATE),
+                              headers={"X-Telegram-Bot-Api-Secret-Token": SECRET, "Content-Type": "application/json"})
+        assert r.status == 200
+        update = queue.get_nowait()
+        assert isinstance(update, Update)
+        assert update.update_id == 42 and update.message.text == "/start"
+
+    run_client(monkeypatch, scenario)
+
+
+def test_healthz(monkeypatch):
+    async def scenario(client, queue):
+        queue.put_nowait(object())
+        r = await client.get("/healthz")
+        assert r.status == 200
+        body = await r.json()
+        assert body["ok"] is True and body["mode"] == "webhook" and body["update_queue"] == 1
+
+    run_client(monkeypatch, scenario)